@@ -0,0 +1,217 @@
+"""time the api hot paths against a synthetic database
+
+Example:
+    python benchmarks/run_benchmarks.py -o baseline.json
+    (make changes)
+    python benchmarks/run_benchmarks.py -o new.json --baseline baseline.json
+
+Results are written as json, {"meta": {...}, "results": {name: {...}}}.
+With --baseline each result is compared against the stored value, and the
+script exits with status 1 if any is slower by more than --threshold.
+"""
+
+import sys, os, io, json, time, random, tempfile, shutil, argparse, contextlib, platform, sqlite3, statistics
+from wsgiref.util import setup_testing_defaults
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+from simpleosmapi import OsmData, make_osm_xml, make_osm_change_xml, read_osm_change_xml
+import synthetic
+
+
+parser = argparse.ArgumentParser(description="""
+benchmark simpleosmapi against a synthetic database""")
+
+parser.add_argument("-o", "--output", metavar='output', type=str, default=None,
+    help="write results to this json file")
+parser.add_argument("--baseline", metavar='baseline', type=str, default=None,
+    help="compare against results stored in this json file")
+parser.add_argument("--threshold", metavar='threshold', type=float, default=1.25,
+    help="report a regression when a median time exceeds the baseline by this factor (default 1.25)")
+parser.add_argument("-n", "--nodes", metavar='nodes', type=int, default=50000)
+parser.add_argument("-w", "--ways", metavar='ways', type=int, default=5000)
+parser.add_argument("-r", "--relations", metavar='relations', type=int, default=500)
+parser.add_argument("-d", "--density", metavar='density', type=float, default=50000,
+    help="nodes per square degree")
+parser.add_argument("--repeat", metavar='repeat', type=int, default=5,
+    help="number of times each benchmark is run")
+parser.add_argument("--codec", metavar='codec', type=str, default='packed', choices=['packed','json'])
+parser.add_argument("--seed", metavar='seed', type=int, default=1)
+parser.add_argument("--only", metavar='prefix', type=str, default=None,
+    help="only run benchmarks whose name starts with prefix")
+parser.add_argument("-v", "--verbose", action='store_true',
+    help="show output printed by simpleosmapi while benchmarks run")
+
+
+class Bench:
+    def __init__(self, repeat, only=None, verbose=False):
+        self.repeat = repeat
+        self.only = only
+        self.verbose = verbose
+        self.results = {}
+
+    def quiet(self):
+        if self.verbose:
+            return contextlib.nullcontext()
+        return contextlib.redirect_stdout(io.StringIO())
+
+    def run(self, name, func, setup=None, **info):
+        """call func repeat times, recording the median and minimum time.
+setup is called (untimed) before each run, and its result passed to func"""
+        if self.only and not name.startswith(self.only):
+            return
+        times = []
+        for i in range(self.repeat):
+            with self.quiet():
+                arg = setup() if setup is not None else None
+                st = time.perf_counter()
+                res = func(arg) if setup is not None else func()
+                times.append(time.perf_counter()-st)
+        result = {'median': statistics.median(times), 'min': min(times), 'repeat': self.repeat}
+        if isinstance(res, int):
+            result['count'] = res
+        result.update(info)
+        self.results[name] = result
+        print("%-32s %10.2fms %10.2fms %s" % (name, result['median']*1000, result['min']*1000,
+            "" if not 'count' in result else "(%d)" % result['count']))
+
+
+def wsgi_request(app, method, path, body=b''):
+    """call a wsgi app directly, returning the status and response body"""
+    path, _, query = path.partition('?')
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query,
+        'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)}
+    setup_testing_defaults(environ)
+    status = []
+    def start_response(st, headers, exc_info=None):
+        status.append(st)
+    result = app(environ, start_response)
+    try:
+        data = b"".join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return status[0], data
+
+
+def bench_queries(bench, data, extent, rand):
+    side = extent[2]-extent[0]
+    for frac in (0.01, 0.05, 0.2):
+        boxes = [synthetic.random_box(rand, extent, side*frac) for i in range(bench.repeat)]
+        it = iter(boxes)
+        bench.run("iter_elements_%g" % frac, lambda box: sum(1 for e in data.iter_elements(box)),
+            lambda: next(it), box_size=side*frac)
+
+    box = synthetic.random_box(rand, extent, side*0.2)
+    with bench.quiet():
+        eles = list(data.iter_elements(box))
+    bench.run("make_osm_xml", lambda: len(make_osm_xml(eles)), elements=len(eles))
+
+    changes = [('modify', e) for e in eles]
+    xml = make_osm_change_xml(changes)
+    bench.run("make_osm_change_xml", lambda: len(make_osm_change_xml(changes)), elements=len(eles))
+    bench.run("read_osm_change_xml", lambda: sum(1 for c in read_osm_change_xml(xml)), elements=len(eles), size=len(xml))
+
+
+def bench_uploads(bench, data, extent, rand, max_node):
+    for size in (10, 100, 1000):
+        def setup():
+            cid = data.next_changeset().id
+            return cid, synthetic.make_upload(rand, extent, size, max_node)
+        bench.run("add_changeset_data_%d" % size, lambda arg: len(data.add_changeset_data(*arg)), setup)
+
+
+def bench_routes(bench, server, extent, rand, max_node):
+    app = server.bottle.default_app()
+    side = extent[2]-extent[0]
+    for frac in (0.01, 0.05):
+        def setup():
+            box = synthetic.random_box(rand, extent, side*frac)
+            return "/api/0.6/map?bbox=%s" % ",".join("%f" % x for x in box)
+        bench.run("route_map_%g" % frac, lambda path: len(wsgi_request(app, 'GET', path)[1]), setup)
+
+    def upload(body):
+        status, cid = wsgi_request(app, 'PUT', '/api/0.6/changeset/create')
+        cid = int(cid)
+        status, resp = wsgi_request(app, 'POST', '/api/0.6/changeset/%d/upload' % cid, body)
+        if not status.startswith('200'):
+            raise Exception("upload failed: %s %s" % (status, resp[:200]))
+        wsgi_request(app, 'PUT', '/api/0.6/changeset/%d/close' % cid)
+        return len(resp)
+    bench.run("route_upload_100", upload,
+        lambda: make_osm_change_xml(synthetic.make_upload(rand, extent, 100, max_node)))
+
+
+def compare(results, baseline, threshold):
+    """print the change from baseline for each result, returning the names
+of any which are slower than baseline by more than threshold"""
+    regressions = []
+    print("\n%-32s %12s %12s %8s" % ("", "baseline", "now", "ratio"))
+    for name, res in sorted(results.items()):
+        if not name in baseline:
+            continue
+        ratio = res['median'] / baseline[name]['median'] if baseline[name]['median'] else float('inf')
+        flag = ""
+        if ratio > threshold:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print("%-32s %10.2fms %10.2fms %8.2f%s" % (name, baseline[name]['median']*1000, res['median']*1000, ratio, flag))
+    return regressions
+
+
+def main(args):
+    rand = random.Random(args.seed)
+    tempdir = tempfile.mkdtemp(prefix='simpleosmapi_bench')
+    try:
+        filename = os.path.join(tempdir, 'bench.db')
+        bench = Bench(args.repeat, args.only, args.verbose)
+
+        with bench.quiet():
+            eles, extent = synthetic.generate(args.nodes, args.ways, args.relations, args.density, args.seed)
+            st = time.perf_counter()
+            synthetic.make_database(filename, eles, args.codec)
+            load_time = time.perf_counter()-st
+        print("%-32s %10.2fms" % ("bulk_load (once)", load_time*1000))
+        bench.results['bulk_load'] = {'median': load_time, 'min': load_time, 'repeat': 1}
+
+        #the server module opens its own OsmData, so the read only benchmarks
+        #and the uploads use separate connections to the same file
+        with bench.quiet():
+            data = OsmData(filename, 1, 'synthetic')
+        bench_queries(bench, data, extent, rand)
+        bench_uploads(bench, data, extent, rand, args.nodes)
+        del data
+
+        import simpleosmapi_server
+        with bench.quiet():
+            simpleosmapi_server.setup(filename, 1, 'synthetic')
+        bench_routes(bench, simpleosmapi_server, extent, rand, args.nodes)
+    finally:
+        shutil.rmtree(tempdir)
+
+    output = {'meta': {
+            'nodes': args.nodes, 'ways': args.ways, 'relations': args.relations,
+            'density': args.density, 'codec': args.codec, 'seed': args.seed, 'repeat': args.repeat,
+            'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())},
+        'results': bench.results}
+
+    if args.output:
+        with open(args.output, 'w') as obj:
+            json.dump(output, obj, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as obj:
+            baseline = json.load(obj)
+        if baseline['meta'].get('nodes') != args.nodes or baseline['meta'].get('codec') != args.codec:
+            print("baseline was run with different parameters: %s" % json.dumps(baseline['meta']))
+        regressions = compare(bench.results, baseline['results'], args.threshold)
+        if regressions:
+            print("regressions: %s" % ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
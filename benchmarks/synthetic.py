@@ -0,0 +1,114 @@
+import random, math
+
+from simpleosmapi import make_sqlite, bulk_load, Node, Way, Relation
+
+
+_timestamp = "2020-01-01T00:00:00Z"
+
+def _tags(rand, choices, num):
+    return dict(rand.choice(choices) for i in range(num))
+
+_node_tags = [('amenity','bench'), ('highway','crossing'), ('barrier','gate'), ('natural','tree'), ('name','Node & "Co"')]
+_way_tags = [('highway','residential'), ('highway','service'), ('building','yes'), ('landuse','grass'), ('name','Ünïcode street'), ('surface','asphalt')]
+_relation_tags = [('type','multipolygon'), ('type','route'), ('route','bus'), ('name','Some route'), ('network','local')]
+
+
+def generate(nodes=20000, ways=2000, relations=200, density=20000, seed=1, origin=(0.0, 0.0)):
+    """generate a synthetic dataset
+
+Nodes are scattered uniformly over a square, sized so that there are
+density nodes per square degree. Each way takes between 2 and 20 nodes
+from the same small area, and each relation has a mix of nearby nodes and
+ways, and sometimes a relation created earlier.
+
+Args:
+    nodes (int): number of nodes
+    ways (int): number of ways
+    relations (int): number of relations
+    density (float): nodes per square degree
+    seed (int): random seed
+    origin (tuple): lon, lat of the south west corner
+Returns:
+    tuple of the list of elements and their extent [minlon, minlat, maxlon,
+maxlat] in degrees
+"""
+    rand = random.Random(seed)
+    side = math.sqrt(nodes / density)
+    x0, y0 = origin
+
+    #nodes are grouped by grid cell, so ways and relations can pick nearby
+    #nodes and ways
+    cells_per_side = max(1, int(math.sqrt(nodes / 50)))
+    cell_nodes = {}
+    eles = []
+    for i in range(nodes):
+        lon, lat = x0 + rand.random()*side, y0 + rand.random()*side
+        cell = (int((lon-x0)/side*cells_per_side), int((lat-y0)/side*cells_per_side))
+        cell_nodes.setdefault(cell, []).append(i+1)
+        tags = _tags(rand, _node_tags, rand.choice((0,0,0,0,1,2)))
+        eles.append(Node(i+1, 1, 1, _timestamp, 'synthetic', 1, tags, True, int(lon*10000000), int(lat*10000000)))
+
+    cells = sorted(cell_nodes)
+    cell_ways = {}
+    for i in range(ways):
+        cell = rand.choice(cells)
+        cands = cell_nodes[cell]
+        refs = [rand.choice(cands) for j in range(rand.randint(2, 20))]
+        cell_ways.setdefault(cell, []).append(i+1)
+        tags = _tags(rand, _way_tags, rand.randint(1, 4))
+        eles.append(Way(i+1, 1, 1, _timestamp, 'synthetic', 1, tags, True, refs))
+
+    for i in range(relations):
+        cell = rand.choice(cells)
+        members = [{'type': 'node', 'ref': rand.choice(cell_nodes[cell]), 'role': 'stop'} for j in range(rand.randint(0, 5))]
+        members += [{'type': 'way', 'ref': w, 'role': rand.choice(('outer','inner',''))}
+            for w in rand.sample(cell_ways.get(cell, []), min(len(cell_ways.get(cell, [])), rand.randint(1, 10)))]
+        if i > 0 and rand.random() < 0.2:
+            members.append({'type': 'relation', 'ref': rand.randint(1, i), 'role': 'subarea'})
+        tags = _tags(rand, _relation_tags, rand.randint(1, 3))
+        eles.append(Relation(i+1, 1, 1, _timestamp, 'synthetic', 1, tags, True, members))
+
+    return eles, [x0, y0, x0+side, y0+side]
+
+
+def make_database(filename, eles, codec='packed'):
+    """write elements to a new sqlite database at filename"""
+    conn = make_sqlite(filename, True, codec=codec)
+    bulk_load(conn, eles)
+    conn.close()
+
+
+def random_box(rand, extent, size):
+    """bbox of given size (in degrees) placed randomly within extent"""
+    x = extent[0] + rand.random()*max(0, extent[2]-extent[0]-size)
+    y = extent[1] + rand.random()*max(0, extent[3]-extent[1]-size)
+    return [x, y, x+size, y+size]
+
+
+def make_upload(rand, extent, size, max_node):
+    """list of (change_type, element) tuples, as a client would upload: at
+least size changes made up of moved existing nodes, and new ways each with
+four new nodes and one existing node. The changeset is given as 0, the
+server replaces it with the changeset uploaded to."""
+    changes = []
+    new_id = -1
+    while len(changes) < size:
+        if rand.random() < 0.5:
+            lon = extent[0] + rand.random()*(extent[2]-extent[0])
+            lat = extent[1] + rand.random()*(extent[3]-extent[1])
+            changes.append(('modify', Node(rand.randint(1, max_node), 0, 1, _timestamp, 'synthetic', 1,
+                {'amenity': 'bench'}, True, int(lon*10000000), int(lat*10000000))))
+            continue
+
+        refs = []
+        lon = extent[0] + rand.random()*(extent[2]-extent[0])
+        lat = extent[1] + rand.random()*(extent[3]-extent[1])
+        for j in range(4):
+            changes.append(('create', Node(new_id, 0, 0, _timestamp, 'synthetic', 1, {}, True,
+                int((lon+j*0.0001)*10000000), int(lat*10000000))))
+            refs.append(new_id)
+            new_id -= 1
+        refs.append(rand.randint(1, max_node))
+        changes.append(('create', Way(new_id, 0, 0, _timestamp, 'synthetic', 1, {'highway': 'footway'}, True, refs)))
+        new_id -= 1
+    return changes
@@ -9,7 +9,7 @@ setup(name='simpleosmapi',
 
       url='https://www.github.com/jharris2268/osmutils',
       packages = find_packages(),
-      scripts=['simpleosmapi_server.py',],
+      scripts=['simpleosmapi_server.py','simpleosmapi_migrate.py','simpleosmapi_import.py'],
       include_package_data=True,
       zip_safe=False
 )
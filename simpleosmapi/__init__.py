@@ -1,7 +1,16 @@
 
 from .osmdata import OsmData,read_osm_xml, read_osm_change_xml, make_sqlite
-from .xml import to_xml, elements_from_api, make_osm_xml, make_osm_change_xml, commit_changes, osm_headers
+from .xml import to_xml, elements_from_api, make_osm_xml, iter_osm_xml, make_osm_change_xml, commit_changes, osm_headers
 from .elements import Node, Way, Relation, Changeset, element_key
+from .database import migrate_codec, rebuild_boxes
+from .bulkload import bulk_load
+from .changes import plan_changes
+from .cache import ResponseCache
+from .pbf import read_pbf, iter_pbf, make_pbf
+from .metrics import Metrics
+from .asgi import AsgiApp
+from .prefork import serve_prefork
+from .replication import Replication
 
 
 
@@ -0,0 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio, sys, tempfile
+
+_read_methods = ('GET', 'HEAD', 'OPTIONS')
+
+
+class AsgiApp:
+    """serve a wsgi application (e.g. the bottle app of
+simpleosmapi_server.py) from an asgi server.
+
+The event loop only handles the network traffic. Requests which may change
+the database (PUT, POST, DELETE) are run one at a time on a single writer
+thread, all others on a pool of reader threads, so that a slow upload
+doesn't hold up map requests. Responses are streamed, each chunk being
+sent as it is ready. After the first, the chunks of read requests are
+produced on a separate pool of stream threads: a reader thread may be
+blocked waiting for a database connection held by a response which is
+still streaming, so those responses must never wait for a reader thread.
+
+Example:
+    >>> app = AsgiApp(bottle.default_app(), readers=8)
+    >>> uvicorn.run(app, host='localhost', port=9005)
+"""
+
+    def __init__(self, wsgi_app, readers=4, max_memory_body=1024*1024):
+        """
+Args:
+    wsgi_app: wsgi application
+    readers (int): number of reader threads, and of stream threads. OsmData
+should be opened with at least this many read only connections
+    max_memory_body (int): request bodies larger than this are spooled to a
+temporary file
+"""
+        self.wsgi_app = wsgi_app
+        self.max_memory_body = max_memory_body
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix='simpleosmapi-writer')
+        self.readers = ThreadPoolExecutor(readers, thread_name_prefix='simpleosmapi-reader')
+        self.streams = ThreadPoolExecutor(readers, thread_name_prefix='simpleosmapi-stream')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise Exception("unsupported scope type %s" % scope['type'])
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.writer.shutdown()
+                self.readers.shutdown()
+                self.streams.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = tempfile.SpooledTemporaryFile(self.max_memory_body)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        size = body.tell()
+        body.seek(0)
+
+        environ = _make_environ(scope, body, size)
+        if scope['method'] in _read_methods:
+            executor, stream_executor = self.readers, self.streams
+        else:
+            executor = stream_executor = self.writer
+        loop = asyncio.get_running_loop()
+
+        started = []
+        written = []
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+            return written.append
+
+        def begin():
+            result = self.wsgi_app(environ, start_response)
+            chunks = iter(result)
+            #the status and headers may not be given until the first chunk
+            return result, chunks, next(chunks, None)
+
+        result, chunks, chunk = await loop.run_in_executor(executor, begin)
+        try:
+            status, headers = started
+            await send({'type': 'http.response.start', 'status': int(status.split()[0]),
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k,v in headers]})
+            for data in written:
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(stream_executor, next, chunks, None)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(stream_executor, result.close)
+            body.close()
+
+
+def _make_environ(scope, body, size):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'CONTENT_LENGTH': str(size),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for key, val in scope.get('headers', []):
+        key = key.decode('latin-1').upper().replace('-', '_')
+        val = val.decode('latin-1')
+        if key == 'CONTENT_LENGTH':
+            continue
+        if key != 'CONTENT_TYPE':
+            key = 'HTTP_' + key
+        environ[key] = environ[key] + ',' + val if key in environ else val
+    return environ
+
+
+asgi_servers = ('uvicorn', 'hypercorn')
+
+def run_asgi(app, host='localhost', port=9005, server='uvicorn'):
+    """serve app with one of asgi_servers, which must be installed"""
+    if server == 'uvicorn':
+        import uvicorn
+        uvicorn.run(app, host=host, port=port)
+    elif server == 'hypercorn':
+        import hypercorn.asyncio, hypercorn.config
+        config = hypercorn.config.Config()
+        config.bind = ['%s:%d' % (host, port)]
+        asyncio.run(hypercorn.asyncio.serve(app, config))
+    else:
+        raise Exception("unknown asgi server %s" % repr(server))
@@ -0,0 +1,176 @@
+from .database import get_meta, set_meta, _create_indices, _drop_indices, _chunks, _update_relation_boxes, _update_way_boxes, _node_ways, _parent_relations
+from .codec import get_codec, decode_refs, decode_members
+import time
+
+
+def _is_empty(conn):
+    for ty in ('node','way','relation'):
+        if list(conn.execute("select 1 from "+ty+" limit 1")):
+            return False
+    return True
+
+class _Loader:
+    def __init__(self, conn, codec, seed):
+        self.conn = conn
+        self.codec = codec
+        self.seed = seed
+        self.counts = {'node': 0, 'way': 0, 'relation': 0}
+        self.seen = {'way': set(), 'relation': set()}
+        self.repeated = {'way': set(), 'relation': set()}
+        self.max_changeset = 0
+
+        conn.execute("create temp table bulk_node (id integer primary key)")
+        conn.execute("create temp table bulk_relation (id integer primary key)")
+        self.changed_ways = []
+
+    def add_batch(self, batch):
+        bytype = {'node': [], 'way': [], 'relation': []}
+        for ele in batch:
+            bytype[ele.type].append(ele)
+            if ele.changeset and ele.changeset > self.max_changeset:
+                self.max_changeset = ele.changeset
+
+        for ty, eles in bytype.items():
+            if not eles:
+                continue
+            #where an element appears more than once only the last is current
+            last = dict((e.id, i) for i,e in enumerate(eles))
+            if not self.seed:
+                self.conn.executemany("update "+ty+" set current=0 where id=? and current=1", [(i,) for i in last])
+
+            rows = [e.values(self.codec, last[e.id]==i) for i,e in enumerate(eles)]
+            self.conn.executemany("insert into "+ty+" values (%s)" % ",".join("?"*len(rows[0])), rows)
+            self.counts[ty] += len(rows)
+
+            if ty=='node':
+                #the ways and relations using nodes which already existed
+                #may have moved
+                if not self.seed:
+                    self.conn.executemany("insert or ignore into bulk_node values (?)", [(i,) for i in last])
+                continue
+
+            for i in last:
+                if i in self.seen[ty]:
+                    self.repeated[ty].add(i)
+                self.seen[ty].add(i)
+
+            current = [eles[i] for i in last.values() if eles[i].visible]
+            if ty=='way':
+                if not self.seed:
+                    self.conn.executemany("delete from way_node where way_id=?", [(i,) for i in last])
+                self.conn.executemany("insert into way_node values (?, ?)",
+                    [(e.id, n) for e in current for n in e.refs])
+            else:
+                if not self.seed:
+                    self.conn.executemany("delete from relation_member where relation_id=?", [(i,) for i in last])
+                self.conn.executemany("insert or ignore into bulk_relation values (?)", [(i,) for i in last])
+                self.conn.executemany("insert into relation_member values (?, ?, ?)",
+                    [(e.id, m['type'][0], int(m['ref'])) for e in current for m in e.members])
+
+    def _reload_repeated(self, ty):
+        #elements loaded more than once have stale rows in way_node and relation_member
+        tab, key = ('way_node', 'way_id') if ty=='way' else ('relation_member', 'relation_id')
+        for ids in _chunks(sorted(self.repeated[ty])):
+            qs = ",".join("?"*len(ids))
+            self.conn.execute("delete from "+tab+" where "+key+" in ("+qs+")", ids)
+            rows = list(self.conn.execute("select id, "+("refs" if ty=='way' else "members")+" from "+ty+
+                " where current=1 and visible=1 and id in ("+qs+")", ids))
+            if ty=='way':
+                self.conn.executemany("insert into way_node values (?, ?)",
+                    [(i, n) for i,refs in rows for n in decode_refs(refs)])
+            else:
+                self.conn.executemany("insert into relation_member values (?, ?, ?)",
+                    [(i, m['type'][0], m['ref']) for i,mems in rows for m in decode_members(mems)])
+
+    def _loaded_nodes(self):
+        return [row[0] for row in self.conn.execute("select id from bulk_node")]
+
+    def calc_way_boxes(self):
+        self._reload_repeated('way')
+        ids = set(self.seen['way'])
+        ids.update(_node_ways(self.conn.cursor(), self._loaded_nodes()))
+        self.changed_ways = _update_way_boxes(self.conn.cursor(), ids)
+        return len(self.changed_ways)
+
+    def calc_relation_boxes(self, max_depth=20):
+        self._reload_repeated('relation')
+        ids = set(row[0] for row in self.conn.execute("select id from bulk_relation"))
+        members = [('n', i) for i in self._loaded_nodes()] + [('w', i) for i in self.changed_ways]
+        if members:
+            ids.update(_parent_relations(self.conn.cursor(), members))
+        return _update_relation_boxes(self.conn.cursor(), ids, max_depth)
+
+    def finish(self):
+        if self.seed:
+            _create_indices(self.conn, rtree=False)
+            for ty in ('node','way','relation'):
+                self.conn.execute("update "+ty+" set current=0 where current=1 and rowid < (select max(rowid) from "+ty+" t where t.id="+ty+".id and t.current=1)")
+
+        nw = self.calc_way_boxes()
+        nr = self.calc_relation_boxes()
+        print("calculated boxes for %d ways, %d relations" % (nw, nr))
+
+        if self.seed:
+            _create_indices(self.conn)
+
+        self.conn.execute("drop table bulk_node")
+        self.conn.execute("drop table bulk_relation")
+
+        if self.max_changeset > int(get_meta(self.conn, 'max_changeset', 0)):
+            set_meta(self.conn, 'max_changeset', self.max_changeset)
+
+
+def bulk_load(conn, elements, batch_size=10000, codec=None):
+    """add many elements to the database in batches, much faster than
+calling OsmData.add_ele for each one
+
+The elements are inserted as given, keeping their ids, versions and
+metadata. Where an element appears more than once the last one is the
+current version. If the database is empty, the indices are dropped while
+loading and recreated afterwards. Way and relation bounding boxes are
+calculated once all the elements have been inserted.
+
+Args:
+    conn: sqlite3 connection object, see make_sqlite
+    elements (iterable): Node, Way and Relation objects, as yielded by
+read_osm_xml, or tuples of (change_type, element), as yielded by
+read_osm_change_xml
+    batch_size (int): number of elements inserted by each executemany call
+    codec (str): column format, defaults to the format used by the database
+Returns:
+    dict of number of elements loaded by type
+"""
+
+    codec = get_codec(codec or get_meta(conn, 'codec', 'json'))
+    st = time.time()
+
+    conn.execute("begin")
+    seed = _is_empty(conn)
+    if seed:
+        _drop_indices(conn)
+    loader = _Loader(conn, codec, seed)
+
+    try:
+        batch = []
+        nb = 0
+        for ele in elements:
+            if isinstance(ele, tuple):
+                ele = ele[1]
+            batch.append(ele)
+            if len(batch) >= batch_size:
+                loader.add_batch(batch)
+                batch = []
+                nb += 1
+                if nb % 100 == 0:
+                    print("%6.1fs: loaded %s" % (time.time()-st, loader.counts))
+        if batch:
+            loader.add_batch(batch)
+
+        print("%6.1fs: loaded %s" % (time.time()-st, loader.counts))
+        loader.finish()
+    except:
+        conn.execute("rollback")
+        raise
+    conn.execute("commit")
+    print("%6.1fs: done" % (time.time()-st,))
+    return loader.counts
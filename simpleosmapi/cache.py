@@ -0,0 +1,209 @@
+from .xml import _mkint
+from .database import overlaps
+from array import array
+from collections import OrderedDict
+import threading, bisect, os
+
+_type_num = {'node': 0, 'way': 1, 'relation': 2}
+
+def _ele_key(ty, id):
+    return id*4 + _type_num[ty]
+
+
+class _Entry:
+    __slots__ = ('box', 'keys', 'data', 'path')
+
+    def __init__(self, box, keys, data, path=None):
+        self.box = box
+        self.keys = keys
+        self.data = data
+        self.path = path
+
+    def contains(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i]==key
+
+    def affected(self, box, keys):
+        if self.box is None:
+            return True
+        if box is not None and overlaps(self.box, box):
+            return True
+        return any(self.contains(k) for k in keys)
+
+
+class ResponseCache:
+    """LRU cache of /api/0.6/map responses, keyed by the requested bbox.
+
+Each entry keeps the bbox requested and the (sorted) ids of the elements
+in the response. After an upload, invalidate is called with the area
+covered by the upload and the elements it changed. Any entry with an
+overlapping box, or containing any of the changed elements (or, for a
+changed relation, any of its members) is dropped.
+
+Entries evicted from memory are written to directory, if given, and read
+back on the next request.
+
+Example:
+    >>> cache = ResponseCache(256)
+    >>> data.listeners.append(cache.invalidate)
+    >>> resp = cache.get(box)
+    >>> if resp is None:
+    ...     resp = cache.iter_response(box, data.iter_elements(box), iter_osm_xml)
+"""
+
+    def __init__(self, max_entries=256, max_bytes=256*1024*1024, directory=None, max_disk_entries=4096):
+        """
+Args:
+    max_entries (int): number of responses kept in memory
+    max_bytes (int): total size of responses kept in memory. Larger
+responses are not cached
+    directory (str): directory to write responses evicted from memory, or
+None
+    max_disk_entries (int): number of responses kept in directory
+"""
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.disk_entries = OrderedDict()
+        self.size = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+        if directory is not None:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            #entries left by a previous run may be stale
+            for fn in os.listdir(directory):
+                if fn.endswith('.osmcache'):
+                    os.remove(os.path.join(directory, fn))
+
+    def key(self, box):
+        """normalized cache key for a bbox in degrees"""
+        if box is None:
+            return None
+        return tuple(_mkint(x) for x in box)
+
+    def get(self, box):
+        """cached response for box, or None"""
+        key = self.key(box)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key].data
+
+            if key in self.disk_entries:
+                entry = self.disk_entries.pop(key)
+                with open(entry.path, 'rb') as obj:
+                    entry.data = obj.read()
+                os.remove(entry.path)
+                entry.path = None
+                self._add(key, entry)
+                self.hits += 1
+                return entry.data
+            self.misses += 1
+        return None
+
+    def put(self, box, data, eles_keys, generation):
+        """store response for box. Ignored if any responses have been
+invalidated since generation, as data may be out of date.
+
+Args:
+    box (list): bbox in degrees, or None
+    data (bytes): response
+    eles_keys (iterable): keys (see _ele_key) of elements in the response
+    generation (int): value of self.generation when the response was started
+"""
+        keys = array('q', sorted(eles_keys))
+        key = self.key(box)
+        with self.lock:
+            if generation != self.generation:
+                return
+            self._remove(key)
+            self._add(key, _Entry(key, keys, data))
+
+    def iter_response(self, box, eles, serialize):
+        """serialize eles, yielding chunks as serialize does, and store the
+complete response once the iterator is exhausted. Responses larger than
+max_bytes are not kept, and stop being collected once they pass it, so
+large responses are still streamed without being held in memory."""
+        generation = self.generation
+        keys = []
+        chunks = []
+        def record(eles):
+            for e in eles:
+                if chunks is not None:
+                    keys.append(_ele_key(e.type, e.id))
+                yield e
+
+        size = 0
+        for chunk in serialize(record(eles)):
+            if chunks is not None:
+                size += len(chunk)
+                if size > self.max_bytes:
+                    chunks, keys = None, None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            self.put(box, b"".join(chunks), keys, generation)
+
+    def invalidate(self, box, changes):
+        """drop entries affected by an upload
+
+Args:
+    box (list): bbox of changed elements, as integers
+    changes (list): tuples of element type, id and (for relations) a list
+of members
+"""
+        keys = []
+        for ty, id, members in changes:
+            keys.append(_ele_key(ty, id))
+            if members:
+                keys.extend(_ele_key(m['type'], int(m['ref'])) for m in members)
+
+        with self.lock:
+            self.generation += 1
+            for store in (self.entries, self.disk_entries):
+                for key in [k for k,e in store.items() if e.affected(box, keys)]:
+                    self._remove(key)
+
+    def clear(self):
+        """drop all entries"""
+        with self.lock:
+            self.generation += 1
+            for store in (self.entries, self.disk_entries):
+                for key in list(store):
+                    self._remove(key)
+
+    def _add(self, key, entry):
+        self.entries[key] = entry
+        self.size += len(entry.data)
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            old_key, old = self.entries.popitem(last=False)
+            self.size -= len(old.data)
+            self._spill(old_key, old)
+
+    def _spill(self, key, entry):
+        if self.directory is None:
+            return
+        name = 'all' if key is None else '_'.join(str(k) for k in key)
+        entry.path = os.path.join(self.directory, name+'.osmcache')
+        with open(entry.path, 'wb') as obj:
+            obj.write(entry.data)
+        entry.data = None
+        self.disk_entries[key] = entry
+        while len(self.disk_entries) > self.max_disk_entries:
+            old_key, old = self.disk_entries.popitem(last=False)
+            os.remove(old.path)
+
+    def _remove(self, key):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key).data)
+        if key in self.disk_entries:
+            os.remove(self.disk_entries.pop(key).path)
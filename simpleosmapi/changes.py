@@ -0,0 +1,99 @@
+import heapq
+
+_type_order = {'node': 0, 'way': 1, 'relation': 2}
+_change_types = ('create', 'modify', 'delete')
+
+
+def _element_refs(ele):
+    if ele.type=='way':
+        return [('node', n) for n in ele.refs]
+    if ele.type=='relation':
+        return [(m['type'], int(m['ref'])) for m in ele.members]
+    return []
+
+def _describe(change):
+    ct, ele = change
+    return "%s %s %d" % (ct, ele.type, ele.id)
+
+def plan_changes(changes):
+    """order an upload so that each element is added after any it depends on
+
+Created elements have negative placeholder ids, which other elements in
+the same upload may refer to. Creates and modifies are ordered so that
+every placeholder is created before it is used, otherwise keeping nodes
+before ways before relations. Deletes come last, relations first. Changes
+to the same element keep the order given.
+
+Args:
+    changes (list): tuples of change type ('create', 'modify' or 'delete')
+and Node, Way or Relation objects, as yielded by read_osm_change_xml
+Returns:
+    list of the same tuples, in the order they should be applied
+Raises:
+    Exception if the upload refers to placeholders which aren't created,
+creates the same placeholder twice, or has created elements which depend
+on each other
+"""
+    errors = []
+    created = {}
+    for i,(ct,ele) in enumerate(changes):
+        if not ct in _change_types:
+            raise Exception("wrong change_type %s" % repr(ct))
+        if ct=='create':
+            key = (ele.type, ele.id)
+            if key in created:
+                errors.append("%s created twice" % _describe((ct,ele)))
+            created[key] = i
+        elif ele.id < 0:
+            errors.append("%s: can't %s placeholder" % (_describe((ct,ele)), ct))
+
+    deps = [set() for c in changes]
+    last_seen = {}
+    for i,(ct,ele) in enumerate(changes):
+        if ct!='delete':
+            for ty,ref in _element_refs(ele):
+                if ref >= 0:
+                    continue
+                if not (ty,ref) in created:
+                    errors.append("%s: unknown %s %d" % (_describe((ct,ele)), ty, ref))
+                elif created[ty,ref] != i:
+                    deps[i].add(created[ty,ref])
+
+        if ct!='create':
+            key = (ele.type, ele.id)
+            if key in last_seen:
+                deps[i].add(last_seen[key])
+            last_seen[key] = i
+
+    if errors:
+        raise Exception("invalid upload: " + "; ".join(errors))
+
+    users = [[] for c in changes]
+    for i,dd in enumerate(deps):
+        for j in dd:
+            users[j].append(i)
+
+    def priority(i):
+        ct, ele = changes[i]
+        if ct=='delete':
+            return (1, -_type_order[ele.type], i)
+        return (0, _type_order[ele.type], i)
+
+    remaining = [len(dd) for dd in deps]
+    ready = [priority(i) for i,n in enumerate(remaining) if n==0]
+    heapq.heapify(ready)
+
+    result = []
+    while ready:
+        i = heapq.heappop(ready)[2]
+        result.append(changes[i])
+        for j in users[i]:
+            remaining[j] -= 1
+            if remaining[j]==0:
+                heapq.heappush(ready, priority(j))
+
+    if len(result) < len(changes):
+        cycle = [_describe(changes[i]) for i,n in enumerate(remaining) if n>0]
+        raise Exception("invalid upload: circular references between %s" % ", ".join(cycle))
+
+    return result
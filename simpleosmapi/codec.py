@@ -0,0 +1,108 @@
+import json, sys, struct
+from array import array
+from itertools import accumulate
+
+#json codec values are stored as text, packed values as blobs, so the
+#decode functions can read either without knowing which codec was used
+
+_member_types = {'n': 'node', 'w': 'way', 'r': 'relation'}
+_little_endian = sys.byteorder == 'little'
+
+
+class JsonCodec:
+    """store tags, refs and members as json text (the original format)"""
+    name = 'json'
+
+    def is_encoded(self, val):
+        return isinstance(val, str)
+
+    def encode_tags(self, tags):
+        return json.dumps(tags)
+
+    def encode_refs(self, refs):
+        return json.dumps(refs)
+
+    def encode_members(self, members):
+        return json.dumps(members)
+
+
+_int_types = (('b', 1<<7), ('h', 1<<15), ('i', 1<<31))
+
+def _pack_ints(vals):
+    """first value, then deltas as an array of the smallest int type which fits"""
+    deltas = [b-a for a,b in zip(vals, vals[1:])]
+    tc = 'b'
+    if deltas:
+        lo, hi = min(deltas), max(deltas)
+        tc = next((tc for tc,lim in _int_types if lo>=-lim and hi<lim), 'q')
+    arr = array(tc, deltas)
+    if not _little_endian: arr.byteswap()
+    return tc.encode('ascii'), struct.pack('<q', vals[0]) + arr.tobytes()
+
+def _unpack_ints(tc, data):
+    first, = struct.unpack_from('<q', data)
+    arr = array(tc)
+    arr.frombytes(data[8:])
+    if not _little_endian: arr.byteswap()
+    return list(accumulate(arr, initial=first))
+
+
+class PackedCodec:
+    """store refs as delta encoded int arrays, and tags and members as
+nul separated utf8 strings. Decoded keys and roles are interned, so that
+repeated values share the same string object."""
+    name = 'packed'
+
+    def is_encoded(self, val):
+        return isinstance(val, bytes)
+
+    def encode_tags(self, tags):
+        if not tags: return b''
+        return "\0".join(x for kv in tags.items() for x in kv).encode('utf-8')
+
+    def encode_refs(self, refs):
+        if not refs: return b''
+        tc, data = _pack_ints(list(refs))
+        return tc + data
+
+    def encode_members(self, members):
+        if not members: return b''
+        tc, data = _pack_ints([int(m['ref']) for m in members])
+        strs = "\0".join(m['type'][0] + m['role'] for m in members).encode('utf-8')
+        return tc + struct.pack('<I', len(data)) + data + strs
+
+
+codecs = {'json': JsonCodec(), 'packed': PackedCodec()}
+json_codec = codecs['json']
+
+def get_codec(name):
+    """codec object for given name ('json' or 'packed')"""
+    if not name in codecs:
+        raise Exception("unknown codec %s" % repr(name))
+    return codecs[name]
+
+
+def decode_tags(val):
+    if isinstance(val, str):
+        return json.loads(val)
+    if not val:
+        return {}
+    it = iter(val.decode('utf-8').split("\0"))
+    return dict(zip(map(sys.intern, it), it))
+
+def decode_refs(val):
+    if isinstance(val, str):
+        return json.loads(val)
+    if not val:
+        return []
+    return _unpack_ints(chr(val[0]), val[1:])
+
+def decode_members(val):
+    if isinstance(val, str):
+        return json.loads(val)
+    if not val:
+        return []
+    nb, = struct.unpack_from('<I', val, 1)
+    refs = _unpack_ints(chr(val[0]), val[5:5+nb])
+    strs = val[5+nb:].decode('utf-8').split("\0")
+    return [{'type': _member_types[s[0]], 'ref': r, 'role': sys.intern(s[1:])} for s,r in zip(strs, refs)]
@@ -1,16 +1,26 @@
 from .elements import Node, Way, Relation, Changeset, element_key
 from .xml import _mkint
+from .codec import get_codec, decode_tags, decode_refs, decode_members
+from .metrics import stage, count
 import json,time, sqlite3, os
 
 
 
-def make_sqlite(fn, create=False, readonly=False):
+_journal_modes = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+_synchronous = ('off', 'normal', 'full', 'extra')
+
+def make_sqlite(fn, create=False, readonly=False, codec='packed', check_same_thread=True, journal_mode=None, synchronous=None):
     """open an sqlite connection to given filename. If empty, and
 create=True, create tables
 
 Args:
     filename (str): sqlite filename
     create (bool): create schema if empty
+    codec (str): 'packed' or 'json', column format used for new schema
+    check_same_thread (bool): passed to sqlite3.connect, set to False for
+connections shared between threads
+    journal_mode (str): if given, set sqlite journal_mode pragma
+    synchronous (str): if given, set sqlite synchronous pragma
 Returns:
     sqlite3 connection object
 
@@ -23,20 +33,31 @@ Returns:
     
     conn=None
     if readonly:
-        conn=sqlite3.connect('file:%s?mode=ro' % fn, uri=True)
+        conn=sqlite3.connect('file:%s?mode=ro' % fn, uri=True, check_same_thread=check_same_thread)
     else:
-        conn=sqlite3.connect(fn,isolation_level=None)
+        conn=sqlite3.connect(fn,isolation_level=None, check_same_thread=check_same_thread)
+    
+    if journal_mode is not None and not readonly:
+        if not journal_mode.lower() in _journal_modes:
+            raise Exception("unexpected journal_mode %s" % repr(journal_mode))
+        conn.execute("pragma journal_mode=%s" % journal_mode)
+    if synchronous is not None:
+        if not synchronous.lower() in _synchronous:
+            raise Exception("unexpected synchronous %s" % repr(synchronous))
+        conn.execute("pragma synchronous=%s" % synchronous)
     try:
         conn.execute("select count(1) from changesets")
+        if not readonly:
+            _upgrade_schema(conn)
         return conn
-    except:
+    except sqlite3.OperationalError:
         pass
     if not create:
         raise Exception("not the expected schema")
         
         
     box="minlon int, minlat int, maxlon int, maxlat int"
-    conn.execute("create table changesets (id integer, user string, uid integer, created string, tags blob, "+box+")")
+    conn.execute("create table changesets (id integer, user string, uid integer, created string, tags blob, "+box+", active bool)")
     conn.execute("create table users (id integer, displayname string)")    
     
     common = "id integer, current bool, changeset integer, version integer, timestamp string, user string, uid integer, visible bool, tags blob"
@@ -44,13 +65,333 @@ Returns:
     conn.execute("create table node ("+common+", lon int, lat int)")
     conn.execute("create table way  ("+common+", refs blob, "+box+")")
     conn.execute("create table relation ("+common+", members blob, "+box+")")
-    conn.execute("create index node_id on node (id)")
-    conn.execute("create index way_id on way (id)")
-    conn.execute("create index relation_id on relation (id)")
-    conn.execute("create index node_loc on node (lon,lat)")
-    conn.execute("create index way_box on way (minlon,minlat,maxlon,maxlat)")
+    conn.execute("create table relation_member (relation_id integer, member_type string, member_ref integer)")
+    conn.execute("create table way_node (way_id integer, node_id integer)")
+    _create_indices(conn)
+    conn.execute("create table meta (key string primary key, value string)")
+    set_meta(conn, 'codec', get_codec(codec).name)
     
     return conn
+
+def _has_table(conn, name):
+    rows = list(conn.execute("select name from sqlite_master where name=?", (name,)))
+    return len(rows)>0
+
+def get_meta(conn, key, default=None):
+    """read value from meta table"""
+    if not _has_table(conn, 'meta'):
+        return default
+    rows = list(conn.execute("select value from meta where key=?", (key,)))
+    return rows[0][0] if rows else default
+
+def set_meta(conn, key, value):
+    """write value to meta table"""
+    conn.execute("insert or replace into meta values (?, ?)", (key, value))
+
+def _upgrade_schema(conn):
+    """add any tables and indices missing from a database created by an
+earlier version"""
+    if not _has_table(conn, 'meta'):
+        #tables written before codecs were added hold json
+        conn.execute("create table meta (key string primary key, value string)")
+        set_meta(conn, 'codec', 'json')
+    if not _has_table(conn, 'node_rtree'):
+        print("adding rtree indices")
+        conn.execute("begin")
+        _create_rtree(conn)
+        conn.execute("drop index if exists node_loc")
+        conn.execute("drop index if exists way_box")
+        conn.execute("commit")
+    
+    if _has_table(conn, 'relation_rtree'):
+        print("dropping relation rtree index")
+        conn.execute("begin")
+        for trig in ('insert', 'current', 'box'):
+            conn.execute("drop trigger if exists relation_rtree_"+trig)
+        conn.execute("drop table relation_rtree")
+        conn.execute("commit")
+    
+    if not _has_table(conn, 'relation_member'):
+        print("adding relation_member table")
+        conn.execute("begin")
+        conn.execute("create table relation_member (relation_id integer, member_type string, member_ref integer)")
+        rows = conn.execute("select id, members from relation where current=1 and visible=1")
+        conn.executemany("insert into relation_member values (?, ?, ?)",
+            ((i, m['type'][0], int(m['ref'])) for i,mems in list(rows) for m in decode_members(mems)))
+        _create_indices(conn)
+        conn.execute("commit")
+    
+    if not 'active' in [r[1] for r in conn.execute("pragma table_info(changesets)")]:
+        #changesets were only written once closed
+        print("adding changesets.active column")
+        conn.execute("alter table changesets add column active bool default 0")
+    
+    if _has_table(conn, 'node_id'):
+        print("replacing id indices with partial indices on current rows")
+        conn.execute("begin")
+        _create_indices(conn)
+        for ty in ('node','way','relation'):
+            conn.execute("drop index if exists "+ty+"_id")
+        conn.execute("commit")
+    
+    #relation_history is created last, and was missing from databases
+    #upgraded by an earlier version of this step
+    if not _has_table(conn, 'relation_history'):
+        print("adding (id, version) indices on old versions")
+        conn.execute("begin")
+        _create_indices(conn)
+        for ty in ('node','way','relation'):
+            conn.execute("drop index if exists "+ty+"_version")
+        conn.execute("commit")
+    
+    if not _has_table(conn, 'way_node'):
+        print("adding way_node table")
+        conn.execute("begin")
+        conn.execute("create table way_node (way_id integer, node_id integer)")
+        rows = conn.execute("select id, refs from way where current=1 and visible=1")
+        conn.executemany("insert into way_node values (?, ?)",
+            ((i, n) for i,refs in list(rows) for n in decode_refs(refs)))
+        _create_indices(conn)
+        conn.execute("commit")
+
+def _chunks(ids, size=500):
+    """split ids into lists short enough to use as sql parameters"""
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i+size]
+
+def _create_indices(conn, rtree=True):
+    """create the element indices and rtree tables. These are dropped by
+bulk_load while filling an empty database, and recreated afterwards"""
+    for ty in ('node','way','relation'):
+        #only current rows are indexed, so lookups never touch old versions
+        conn.execute("create index if not exists "+ty+"_current on "+ty+" (id) where current=1")
+        #old versions, for the history calls. Also partial, so that sqlite
+        #never prefers it to the _current index for current rows
+        conn.execute("create index if not exists "+ty+"_history on "+ty+" (id, version) where current=0")
+    conn.execute("create index if not exists relation_member_ref on relation_member (member_type, member_ref)")
+    conn.execute("create index if not exists relation_member_id on relation_member (relation_id)")
+    if _has_table(conn, 'way_node'):
+        #not yet added by the earlier upgrade steps
+        conn.execute("create index if not exists way_node_node on way_node (node_id)")
+        conn.execute("create index if not exists way_node_way on way_node (way_id)")
+    if rtree and not _has_table(conn, 'node_rtree'):
+        _create_rtree(conn)
+
+def _drop_indices(conn):
+    conn.execute("drop index if exists relation_member_ref")
+    conn.execute("drop index if exists relation_member_id")
+    conn.execute("drop index if exists way_node_node")
+    conn.execute("drop index if exists way_node_way")
+    for ty in ('node','way','relation'):
+        conn.execute("drop index if exists "+ty+"_id")
+        conn.execute("drop index if exists "+ty+"_current")
+        conn.execute("drop index if exists "+ty+"_history")
+        for trig in ('insert', 'current', 'box'):
+            conn.execute("drop trigger if exists "+ty+"_rtree_"+trig)
+        conn.execute("drop table if exists "+ty+"_rtree")
+
+_rtree_point = "new.id, new.lon, new.lon, new.lat, new.lat"
+_rtree_box = "new.id, new.minlon, new.maxlon, new.minlat, new.maxlat"
+
+def _create_rtree(conn):
+    """create rtree_i32 tables holding the extent of each current, visible
+node and way, together with the triggers keeping them up to date, and fill
+them from any existing rows. Relations in a bbox are found through
+relation_member, so their stored boxes aren't indexed"""
+    
+    for ty in ('node','way'):
+        conn.execute("create virtual table "+ty+"_rtree using rtree_i32(id, minlon, maxlon, minlat, maxlat)")
+        
+        if ty=='node':
+            first, vals, cols = "lon", _rtree_point, "lon, lon, lat, lat"
+        else:
+            first, vals, cols = "minlon", _rtree_box, "minlon, maxlon, minlat, maxlat"
+        has_box = "new."+first+" is not null"
+        
+        conn.execute("create trigger "+ty+"_rtree_insert after insert on "+ty+
+            " when new.current and new.visible and "+has_box+
+            " begin insert or replace into "+ty+"_rtree values ("+vals+"); end")
+        
+        conn.execute("create trigger "+ty+"_rtree_current after update of current on "+ty+
+            " when old.current and not new.current"
+            " begin delete from "+ty+"_rtree where id=old.id; end")
+        
+        if ty=='way':
+            conn.execute("create trigger "+ty+"_rtree_box after update of minlon, minlat, maxlon, maxlat on "+ty+
+                " when new.current and new.visible and "+has_box+
+                " begin insert or replace into "+ty+"_rtree values ("+vals+"); end")
+        
+        conn.execute("insert into "+ty+"_rtree select id, "+cols+" from "+ty+
+            " where current=1 and visible=1 and "+first+" is not null")
+    
+def migrate_codec(conn, codec, batch_size=10000):
+    """rewrite the tags, refs and members of every stored element (including
+old versions) using the given codec
+
+Args:
+    conn: sqlite3 connection object
+    codec (str): 'packed' or 'json'
+    batch_size (int): number of rows rewritten with each executemany call
+Returns:
+    number of rows rewritten
+"""
+    codec = get_codec(codec)
+    stored = 'blob' if codec.name=='packed' else 'text'
+    
+    count=0
+    conn.execute("begin")
+    for ty,col,decode,encode in (('node',None,None,None),
+            ('way','refs',decode_refs,codec.encode_refs),
+            ('relation','members',decode_members,codec.encode_members)):
+        
+        cols = "tags" if col is None else "tags, "+col
+        sets = "tags=?" if col is None else "tags=?, "+col+"=?"
+        last = -1
+        while True:
+            rows = list(conn.execute("select rowid, "+cols+" from "+ty+
+                " where rowid>? and typeof(tags)!=? order by rowid limit ?", (last, stored, batch_size)))
+            if not rows:
+                break
+            if col is None:
+                vals = [(codec.encode_tags(decode_tags(r[1])), r[0]) for r in rows]
+            else:
+                vals = [(codec.encode_tags(decode_tags(r[1])), encode(decode(r[2])), r[0]) for r in rows]
+            conn.executemany("update "+ty+" set "+sets+" where rowid=?", vals)
+            count += len(vals)
+            last = rows[-1][0]
+    set_meta(conn, 'codec', codec.name)
+    conn.execute("commit")
+    return count
+
+def _write_ids(curs, table, ids):
+    curs.execute("create temp table if not exists "+table+" (id integer primary key)")
+    curs.execute("delete from "+table)
+    curs.executemany("insert or ignore into "+table+" values (?)", ((i,) for i in ids))
+
+def _parent_relations(curs, members):
+    """ids of current relations with any of members, which are
+(member_type, id) tuples with member_type 'n', 'w' or 'r'"""
+    curs.execute("create temp table if not exists query_members (member_type string, member_ref integer)")
+    curs.execute("delete from query_members")
+    curs.executemany("insert into query_members values (?, ?)", members)
+    curs.execute("""select distinct m.relation_id from query_members q cross join relation_member m
+        on m.member_type=q.member_type and m.member_ref=q.member_ref""")
+    return set(row[0] for row in curs)
+
+def _node_ways(curs, ids):
+    """ids of current ways using any of the nodes ids, from way_node"""
+    _write_ids(curs, 'query_nodes', ids)
+    curs.execute("select distinct w.way_id from query_nodes q cross join way_node w on w.node_id=q.id")
+    return set(row[0] for row in curs)
+
+def _set_boxes(curs, ty, boxes, ids_table):
+    #update the boxes of current elements listed in ids_table which differ
+    #from boxes {id: (minlon, minlat, maxlon, maxlat)}, returning their ids
+    curs.execute("select e.id, e.minlon, e.minlat, e.maxlon, e.maxlat from "+ids_table+" l"
+        " cross join "+ty+" e on e.id=l.id where e.current=1 and e.visible=1")
+    empty = (None,None,None,None)
+    changed = [(i,boxes.get(i, empty)) for i,a,b,c,d in list(curs) if boxes.get(i, empty) != (a,b,c,d)]
+    curs.executemany("update "+ty+" set minlon=?, minlat=?, maxlon=?, maxlat=? where id=? and current=1",
+        [tuple(box)+(i,) for i,box in changed])
+    #the rtree triggers only add boxes
+    cleared = [(i,) for i,box in changed if box[0] is None]
+    if cleared and _has_table(curs.connection, ty+'_rtree'):
+        curs.executemany("delete from "+ty+"_rtree where id=?", cleared)
+    return [i for i,box in changed]
+
+def _update_way_boxes(curs, ids):
+    """set the boxes of current ways from the locations of their nodes,
+found through way_node, with one query however many ways there are
+
+Args:
+    curs: sqlite3 cursor
+    ids (iterable): way ids
+Returns:
+    list of ids of ways whose box changed
+"""
+    _write_ids(curs, 'box_ways', ids)
+    curs.execute("""select w.way_id, min(n.lon), min(n.lat), max(n.lon), max(n.lat)
+        from box_ways l cross join way_node w on w.way_id=l.id cross join node n on n.id=w.node_id
+        where n.current=1 and n.visible=1 group by w.way_id""")
+    boxes = dict((row[0], row[1:]) for row in curs)
+    return _set_boxes(curs, 'way', boxes, 'box_ways')
+
+_relation_member_boxes = """select m.relation_id, min(x0), min(y0), max(x1), max(y1) from (
+        select m.relation_id, n.lon as x0, n.lat as y0, n.lon as x1, n.lat as y1
+            from box_relations l cross join relation_member m on m.relation_id=l.id cross join node n on n.id=m.member_ref
+            where m.member_type='n' and n.current=1 and n.visible=1
+        union all
+        select m.relation_id, w.minlon, w.minlat, w.maxlon, w.maxlat
+            from box_relations l cross join relation_member m on m.relation_id=l.id cross join way w on w.id=m.member_ref
+            where m.member_type='w' and w.current=1 and w.visible=1 and w.minlon is not null
+        union all
+        select m.relation_id, r.minlon, r.minlat, r.maxlon, r.maxlat
+            from box_relations l cross join relation_member m on m.relation_id=l.id cross join relation r on r.id=m.member_ref
+            where m.member_type='r' and r.current=1 and r.visible=1 and r.minlon is not null) m
+    group by m.relation_id"""
+
+def _update_relation_boxes(curs, ids, max_depth=20):
+    """set the boxes of current relations from the extents of their members,
+then recalculate the relations containing any relation whose box changed,
+and so on up to max_depth levels (relations may contain themselves). Each
+level is calculated with one query, however many relations it holds.
+
+Args:
+    curs: sqlite3 cursor
+    ids (iterable): relation ids
+    max_depth (int): maximum number of levels
+Returns:
+    number of relation boxes changed
+"""
+    ids = set(ids)
+    count = 0
+    for depth in range(max_depth):
+        if not ids:
+            break
+        _write_ids(curs, 'box_relations', ids)
+        boxes = dict((row[0], row[1:]) for row in curs.execute(_relation_member_boxes))
+        changed = _set_boxes(curs, 'relation', boxes, 'box_relations')
+        count += len(changed)
+        ids = _parent_relations(curs, [('r', i) for i in changed])
+    return count
+
+def rebuild_boxes(conn):
+    """recalculate the box of every current way from its nodes, then of
+every current relation from its members, for databases where boxes
+weren't kept up to date by uploads
+
+Args:
+    conn: sqlite3 connection object
+Returns:
+    number of way and relation boxes changed
+"""
+    conn.execute("begin")
+    curs = conn.cursor()
+    ids = [row[0] for row in curs.execute("select id from way where current=1 and visible=1")]
+    count = len(_update_way_boxes(curs, ids))
+    ids = [row[0] for row in curs.execute("select id from relation where current=1 and visible=1")]
+    count += _update_relation_boxes(curs, ids, max_depth=100)
+    conn.execute("commit")
+    return count
+
+def _node_locations(curs, ids):
+    """fetch (lon, lat) of current, visible nodes, using one query per
+500 ids
+
+Args:
+    curs: sqlite3 cursor
+    ids (iterable): node ids
+Returns:
+    dict {id: (lon, lat)}, missing nodes are not included
+"""
+    result = {}
+    for ch in _chunks(ids):
+        curs.execute("select id, lon, lat from node where id in (%s) and current=1 and visible=1" % ",".join("?"*len(ch)), ch)
+        for i,lon,lat in curs:
+            result[i]=(lon,lat)
+    return result
+
 def overlaps(A, B):
     if A is None or B is None: return True
     if A[0]>B[2]: return False
@@ -66,19 +407,20 @@ tagstr = lambda tt: "{%s}" % ", ".join("%s='%.20s'" % (k,v) for k,v in tt.iterit
 
 def _make_ele_curs(ty, row):
     if ty=='node':
-        return Node(row[0],row[2],row[3],row[4],row[5],row[6],json.loads(row[8]),row[7],row[9],row[10],None)
+        return Node._from_row(row)
     
     if ty=='way':
-        return Way(row[0],row[2],row[3],row[4],row[5],row[6],json.loads(row[8]),row[7],json.loads(row[9]),None if row[10] is None else row[10:14])
+        return Way._from_row(row, None if row[10] is None else row[10:14])
     
     if ty=='relation':
-        return Relation(row[0],row[2],row[3],row[4],row[5],row[6],json.loads(row[8]),row[7],json.loads(row[9]),None if row[10] is None else row[10:14])
+        return Relation._from_row(row, None if row[10] is None else row[10:14])
 
 
 
 
 def _make_changeset(row):
-    return Changeset(row[0],row[1],row[2],row[3],json.loads(row[4]),None if row[5] is None else row[5:9],False )
+    active = bool(row[9]) if len(row)>9 else False
+    return Changeset(row[0],row[1],row[2],row[3],json.loads(row[4]),None if row[5] is None else list(row[5:9]),active)
     
 
 def _eles_dict(ee):
@@ -88,24 +430,122 @@ def _eles_dict(ee):
         res[e.type][e.id]=e
     return res
 
-def _find_relations(eles, ni, wi):
-    rr = []
-    ri=set([])
-    for e in eles:
-        if e.type == 'relation':
-            if any(m for m in e.members if (m['type']=='node' and m['ref'] in ni) or (m['type']=='way' and m['ref'] in wi)):
-                ri.add(e.id)
-            
-            if any(m for m in e.members if m['type']=='relation'):
-                rr.append(e)
-    print("%d rels with mem, %d rel rels" % (len(ri),len(rr)))
-    for i in range(5):
-        for r in rr:
-            if any(m for m in r.members if m['type']=='relation' and m['ref'] in ri):
-                #print("%d has rel %d" % (r.id,m['ref']))
-                ri.add(r.id)
-    print("%d rels" % len(ri))
-    return ri
+def _fetch_elements(curs, ty, ids, visible_only=True):
+    """fetch current, visible elements of given type and ids. The ids are
+written to a temp table, so that any number can be fetched in one query.
+
+Args:
+    curs: sqlite3 cursor
+    ty (str): 'node', 'way' or 'relation'
+    ids (iterable): element ids
+    visible_only (bool): skip deleted elements
+Returns:
+    list of Node, Way or Relation objects, missing elements are skipped
+"""
+    curs.execute("create temp table if not exists query_ids (id integer primary key)")
+    curs.execute("delete from query_ids")
+    curs.executemany("insert or ignore into query_ids values (?)", ((i,) for i in ids))
+    curs.execute("select e.* from query_ids q cross join "+ty+" e on e.id=q.id where e.current=1"+(" and e.visible=1" if visible_only else ""))
+    return [_make_ele_curs(ty, row) for row in curs]
+
+def _fetch_versions(curs, ty, versions):
+    """fetch given versions of elements, current or not, in one query
+using the _history index for old versions and the _current index for
+current ones
+
+Args:
+    curs: sqlite3 cursor
+    ty (str): 'node', 'way' or 'relation'
+    versions (iterable): (id, version) pairs
+Returns:
+    list of Node, Way or Relation objects, ordered by id and version.
+Missing versions are skipped
+"""
+    curs.execute("create temp table if not exists query_versions (id integer, version integer, primary key (id, version))")
+    curs.execute("delete from query_versions")
+    curs.executemany("insert or ignore into query_versions values (?, ?)", versions)
+    curs.execute("select e.* from query_versions q cross join "+ty+" e on e.id=q.id and e.version=q.version where e.current=0"
+        " union all select e.* from query_versions q cross join "+ty+" e on e.id=q.id and e.version=q.version where e.current=1"
+        " order by id, version")
+    return [_make_ele_curs(ty, row) for row in curs]
+
+def _fetch_history(curs, ty, id_):
+    """fetch every version of an element, ordered by version"""
+    curs.execute("select * from "+ty+" where id=? and current=0"
+        " union all select * from "+ty+" where id=? and current=1 order by version", (id_, id_))
+    return [_make_ele_curs(ty, row) for row in curs]
+
+def _fetch_full(curs, ty, id_):
+    """fetch a current way or relation with every element it refers to: the
+nodes of a way, or the member nodes, ways and relations of a relation, the
+members of those relations to any depth, and the nodes of all the ways.
+Each level is read with one query, however many members there are, with
+the sub-relations found by one recursive query on relation_member.
+
+Args:
+    curs: sqlite3 cursor
+    ty (str): 'way' or 'relation'
+    id (int): element id
+Returns:
+    list of Node, Way and Relation objects, nodes first, then ways, then
+relations. Empty if the element is missing or deleted
+"""
+    ni, wi, rels = set(), set(), []
+    if ty=='way':
+        wi.add(id_)
+    elif ty=='relation':
+        curs.execute("""with recursive children(id) as (
+                select ?
+                union
+                select m.member_ref from children c join relation_member m
+                    on m.relation_id=c.id and m.member_type='r')
+            select id from children""", (id_,))
+        rels = _fetch_elements(curs, 'relation', [row[0] for row in curs])
+        if not any(r.id==id_ for r in rels):
+            return []
+        for r in rels:
+            for m in r.members:
+                if m['type']=='node':
+                    ni.add(int(m['ref']))
+                elif m['type']=='way':
+                    wi.add(int(m['ref']))
+    else:
+        raise Exception("can't fetch full %s" % ty)
+    
+    ways = _fetch_elements(curs, 'way', wi)
+    if ty=='way' and not ways:
+        return []
+    ni.update(n for w in ways for n in w.refs)
+    nodes = _fetch_elements(curs, 'node', ni)
+    count('rows', len(nodes)+len(ways)+len(rels))
+    return nodes + ways + rels
+
+def _find_relations(curs, ni, wi):
+    """fetch current relations with any of the nodes ni or ways wi as
+members, and all relations which contain those relations, using the
+relation_member table
+
+Args:
+    curs: sqlite3 cursor
+    ni (set): node ids
+    wi (set): way ids
+Returns:
+    list of Relation objects
+"""
+    curs.execute("create temp table if not exists query_members (member_type string, member_ref integer)")
+    curs.execute("delete from query_members")
+    curs.executemany("insert into query_members values ('n', ?)", ((i,) for i in ni))
+    curs.executemany("insert into query_members values ('w', ?)", ((i,) for i in wi))
+    
+    curs.execute("""with recursive parents(id) as (
+            select m.relation_id from query_members q cross join relation_member m
+                on m.member_type=q.member_type and m.member_ref=q.member_ref
+            union
+            select m.relation_id from parents p cross join relation_member m
+                on m.member_type='r' and m.member_ref=p.id)
+        select r.* from parents p cross join relation r on r.id=p.id
+        where r.current=1 and r.visible=1 order by r.id""")
+    return [_make_ele_curs('relation', row) for row in curs]
         
 
 def _iter_elements(curs, box):
@@ -116,9 +556,11 @@ def _iter_elements(curs, box):
     
     boxp=[_mkint(box[0]),_mkint(box[1]),_mkint(box[2]),_mkint(box[3])]
     
-    eles = list(_iter_elements_int(curs, boxp))
+    with stage('query'):
+        eles = list(_iter_elements_int(curs, boxp, ('node','way')))
+    count('rows', len(eles))
     if not eles:
-        return
+        return []
     
     #print('have %d eles' % len(eles))
     ww = [e for e in eles if e.type=='way' and overlaps(boxp, e.bbox)]
@@ -127,21 +569,23 @@ def _iter_elements(curs, box):
     nm = ni.difference(set(e.id for e in eles if e.type=='node'))
     wi=set(w.id for w in ww)
     
-    ri = _find_relations(eles, ni, wi)    
+    with stage('relations'):
+        rels = _find_relations(curs, ni, wi)
+    count('rows', len(rels))
+    ri = set(r.id for r in rels)
     
     #print('have %d nodes [%d missing]' % (len(ni), len(nm)))
     if nm:
-        if len(nm)>50:
-            raise Exception("too many nodes missing? [%d]" % len(nm))
-        for i in nm:
-            curs.execute("select * from node where id=? and current=1 and visible=1", (i,))
-            n=list(curs)
-            if len(n)!=1:
-                print("still missing node %d" % i)
-            else:
-                eles.append(_make_ele_curs('node',n[0]))
+        #nodes of ways crossing the edge of the box
+        with stage('fetch_nodes'):
+            found = _fetch_elements(curs, 'node', nm)
+        count('rows', len(found))
+        if len(found) < len(nm):
+            print("still missing %d nodes" % (len(nm)-len(found),))
+        eles.extend(found)
         eles.sort(key=element_key)
-    return _filter_eles(eles, wi, ni,ri)
+    with stage('filter'):
+        return list(_filter_eles(eles+rels, wi, ni,ri))
     
 def _filter_eles(eles, wi, ni, ri):
     
@@ -156,27 +600,17 @@ def _filter_eles(eles, wi, ni, ri):
             
     
     
-def _iter_elements_int(curs, boxp):
-    eles=[]
-    for ty in ('node','way','relation'):
-        qu = "select * from "+ty+" where current=1 and visible=1"
+def _iter_elements_int(curs, boxp, types=('node','way','relation')):
+    
+    for ty in types:
         
         if boxp is None:
-            qu += " order by id"
-            curs.execute(qu)
+            curs.execute("select * from "+ty+" where current=1 and visible=1 order by id")
         else:
-            if ty=='node':
-                qu += " and lon>=?-1000000 and lat>=?-1000000 and lon<=?+1000000 and lat<= ?+1000000"
-                curs.execute(qu,tuple(boxp))
-            elif ty=='way':
-                qu += " and maxlon>=? and maxlat>=? and minlon<=? and minlat<=?"
-                curs.execute(qu,tuple(boxp))
-            else:
-                curs.execute(qu)
+            qb = tuple(boxp)
+            inbox = "select id from "+ty+"_rtree where maxlon>=? and maxlat>=? and minlon<=? and minlat<=?"
+            curs.execute("select e.* from ("+inbox+") r cross join "+ty+" e on e.id=r.id where e.current=1 and e.visible=1", qb)
             
-        
-        
-        
         for rr in curs:                
             yield _make_ele_curs(ty, rr)
             
@@ -1,4 +1,5 @@
 import json
+from .codec import json_codec, decode_tags, decode_refs, decode_members
 
 def _tagstr(tgs):
     return "{%s}" % (", ".join("%s: '%.20s'" % (k,v) for k,v in sorted(tgs.items())),)
@@ -7,6 +8,9 @@ def _boxstr(bx):
     return "[% 10d, % 10d, % 10d, % 10d]" % tuple(bx)
 
 class WithBbox:
+    __slots__ = ('bbox',)
+    _json_fields = ('bbox',)
+    
     def __init__(self, bbox=None):
         self.bbox=bbox
     @property
@@ -38,9 +42,17 @@ class WithBbox:
         
     @property
     def json(self):
-        return dict((k,v) for k,v in self.__dict__.items() if not v is None)
+        return dict((k,getattr(self,k)) for k in self._json_fields if not getattr(self,k) is None)
     
 class Element(WithBbox):
+    """base class for Node, Way and Relation.
+
+Elements read from the database keep the stored tags (and refs or members)
+as they were read, only decoding them when first accessed."""
+    
+    __slots__ = ('id', 'changeset', 'version', 'timestamp', 'user', 'uid', 'visible', '_tags', '_tags_raw')
+    _json_fields = ('bbox', 'id', 'changeset', 'version', 'timestamp', 'user', 'uid', 'tags', 'visible')
+    
     def __init__(self, id, changeset, version, timestamp, user, uid, tags, visible, bbox=None):
         WithBbox.__init__(self, bbox)
         self.id = id
@@ -51,63 +63,172 @@ class Element(WithBbox):
         self.uid = uid
         self.tags = tags
         self.visible=visible
-        self.bbox=bbox
-        
         
+    @classmethod
+    def _from_row(cls, row, bbox):
+        #set fields directly, skipping __init__
+        ele = cls.__new__(cls)
+        ele.id, _, ele.changeset, ele.version, ele.timestamp, ele.user, ele.uid, ele.visible, ele._tags_raw = row[:9]
+        ele._tags = None
+        ele.bbox = bbox
+        return ele
     
-
+    @property
+    def tags(self):
+        if self._tags_raw is not None:
+            self._tags = decode_tags(self._tags_raw)
+            self._tags_raw = None
+        return self._tags
+    
+    @tags.setter
+    def tags(self, tags):
+        self._tags = tags
+        self._tags_raw = None
     
+    @property
+    def extent(self):
+        """bbox covered by element, or None if not known"""
+        return self.bbox
+    
+    def _encoded_tags(self, codec):
+        if self._tags_raw is not None and codec.is_encoded(self._tags_raw):
+            return self._tags_raw
+        return codec.encode_tags(self.tags)
+
+
 
 
 class Node(Element):
+    __slots__ = ('lon', 'lat')
+    _json_fields = Element._json_fields + ('lon', 'lat', 'type')
+    type = 'node'
+    
     def __init__(self, id, changeset, version, timestamp, user, uid, tags, visible, lon, lat, bbox=None):
         Element.__init__(self, id,changeset,version,timestamp,user,uid,tags,visible,bbox)
         self.lon = lon
         self.lat=lat
-        self.type='node'
+    
+    @classmethod
+    def _from_row(cls, row, bbox=None):
+        ele = super()._from_row(row, bbox)
+        ele.lon, ele.lat = row[9], row[10]
+        return ele
+    
+    @property
+    def extent(self):
+        if self.lon is None: return None
+        return [self.lon,self.lat,self.lon,self.lat]
+    
     def __repr__(self):
         return "Node(%d %s % 10d % 10d)" % (self.id, _tagstr(self.tags), self.lon, self.lat)
     
-    def insert(self, curs,check=True):
-        if check: curs.execute("update node set current=0 where id=?",(self.id,))
-        curs.execute("insert into node values (%s)" % ",".join("?"*11), tuple(
-            [self.id,True,self.changeset,self.version,self.timestamp,self.user,self.uid,self.visible,
-            json.dumps(self.tags),self.lon,self.lat]))
+    def values(self, codec=json_codec, current=True):
+        return (self.id,current,self.changeset,self.version,self.timestamp,self.user,self.uid,self.visible,
+            self._encoded_tags(codec),self.lon,self.lat)
+    
+    def insert(self, curs, check=True, codec=json_codec):
+        if check: curs.execute("update node set current=0 where id=? and current=1",(self.id,))
+        curs.execute("insert into node values (%s)" % ",".join("?"*11), self.values(codec))
         
     
     def write_bbox(self, curs):
         curs.execute("update node set minlon=?, minlat=?, maxlon=?, maxlat=? where id=?", (self.minlon,self.minlat,self.maxlat,self.maxlon,self.id))
         
 class Way(Element):
+    __slots__ = ('_refs', '_refs_raw')
+    _json_fields = Element._json_fields + ('refs', 'type')
+    type = 'way'
+    
     def __init__(self, id, changeset, version, timestamp, user, uid, tags, visible, refs, bbox=None):
         Element.__init__(self, id,changeset,version,timestamp,user,uid,tags,visible,bbox)
         self.refs=refs
-        self.type='way'
+    
+    @classmethod
+    def _from_row(cls, row, bbox=None):
+        ele = super()._from_row(row, bbox)
+        ele._refs, ele._refs_raw = None, row[9]
+        return ele
+    
+    @property
+    def refs(self):
+        if self._refs_raw is not None:
+            self._refs = decode_refs(self._refs_raw)
+            self._refs_raw = None
+        return self._refs
+    
+    @refs.setter
+    def refs(self, refs):
+        self._refs = refs
+        self._refs_raw = None
     
     def __repr__(self):
         return "Way(%d %s %d nodes %s)" % (self.id, _tagstr(self.tags), len(self.refs), _boxstr(self.bbox) if self.bbox else '')
 
-    def insert(self, curs,check=True):
-        if check: curs.execute("update way set current=0 where id=?",(self.id,))
-        curs.execute("insert into way values (%s)" % ",".join("?"*14), tuple(
-            [self.id,True,self.changeset,self.version,self.timestamp,self.user,self.uid,self.visible,
-            json.dumps(self.tags),json.dumps(self.refs),self.minlon,self.minlat,self.maxlon,self.maxlat]))
+    def values(self, codec=json_codec, current=True):
+        return (self.id,current,self.changeset,self.version,self.timestamp,self.user,self.uid,self.visible,
+            self._encoded_tags(codec),
+            self._refs_raw if self._refs_raw is not None and codec.is_encoded(self._refs_raw) else codec.encode_refs(self.refs),
+            self.minlon,self.minlat,self.maxlon,self.maxlat)
+    
+    def insert(self, curs, check=True, codec=json_codec):
+        if check: curs.execute("update way set current=0 where id=? and current=1",(self.id,))
+        curs.execute("insert into way values (%s)" % ",".join("?"*14), self.values(codec))
+        
+        #way_node holds the nodes of current ways
+        if check: curs.execute("delete from way_node where way_id=?", (self.id,))
+        if self.visible:
+            curs.executemany("insert into way_node values (?, ?)", [(self.id, n) for n in self.refs])
+
 class Relation(Element):
+    __slots__ = ('_members', '_members_raw')
+    _json_fields = Element._json_fields + ('members', 'type')
+    type = 'relation'
+    
     def __init__(self, id, changeset, version, timestamp, user, uid, tags, visible, members, bbox=None):
         Element.__init__(self, id,changeset,version,timestamp,user,uid,tags,visible,bbox)
         self.members=members
-        self.type='relation'
-    def insert(self, curs, check=True):
-        if check: curs.execute("update relation set current=0 where id=?",(self.id,))
-        curs.execute("insert into relation values (%s)" % ",".join("?"*14), tuple(
-            [self.id,True,self.changeset,self.version,self.timestamp,self.user,self.uid,self.visible,
-            json.dumps(self.tags),json.dumps(self.members),self.minlon,self.minlat,self.maxlon,self.maxlat]))
+    
+    @classmethod
+    def _from_row(cls, row, bbox=None):
+        ele = super()._from_row(row, bbox)
+        ele._members, ele._members_raw = None, row[9]
+        return ele
+    
+    @property
+    def members(self):
+        if self._members_raw is not None:
+            self._members = decode_members(self._members_raw)
+            self._members_raw = None
+        return self._members
+    
+    @members.setter
+    def members(self, members):
+        self._members = members
+        self._members_raw = None
+    def values(self, codec=json_codec, current=True):
+        return (self.id,current,self.changeset,self.version,self.timestamp,self.user,self.uid,self.visible,
+            self._encoded_tags(codec),
+            self._members_raw if self._members_raw is not None and codec.is_encoded(self._members_raw) else codec.encode_members(self.members),
+            self.minlon,self.minlat,self.maxlon,self.maxlat)
+    
+    def insert(self, curs, check=True, codec=json_codec):
+        if check: curs.execute("update relation set current=0 where id=? and current=1",(self.id,))
+        curs.execute("insert into relation values (%s)" % ",".join("?"*14), self.values(codec))
+        
+        #relation_member holds the members of current relations
+        if check: curs.execute("delete from relation_member where relation_id=?", (self.id,))
+        if self.visible:
+            curs.executemany("insert into relation_member values (?, ?, ?)",
+                [(self.id, m['type'][0], int(m['ref'])) for m in self.members])
 
     def __repr__(self):
         return "Relation(%d %s %d members)" % (self.id, _tagstr(self.tags), len(self.members))
 
 
 class Changeset(WithBbox):
+    __slots__ = ('id', 'user', 'uid', 'created_at', 'tags', 'active')
+    _json_fields = ('bbox', 'id', 'user', 'uid', 'created_at', 'tags', 'active')
+    
     def __init__(self, id, user, uid, created_at, tags, bbox,active):
         WithBbox.__init__(self, bbox)
         self.id=id
@@ -119,9 +240,9 @@ class Changeset(WithBbox):
         
     def insert(self, curs):
         curs.execute("delete from changesets where id=?", (self.id,))
-        curs.execute("insert into changesets values (%s)" % ",".join("?"*9), tuple(
+        curs.execute("insert into changesets values (%s)" % ",".join("?"*10), tuple(
             [self.id,self.user,self.uid,self.created_at,
-            json.dumps(self.tags),self.minlon,self.minlat,self.maxlon,self.maxlat]))
+            json.dumps(self.tags),self.minlon,self.minlat,self.maxlon,self.maxlat,self.active]))
 
 
 def element_key(ele):
@@ -0,0 +1,170 @@
+import threading, time, contextlib, bisect
+
+#requests are timed by stages: stage(name) adds the time spent inside it to
+#the current request (less any time in nested stages), and count(name, n)
+#adds to one of its counters. Both do nothing when no request is active, so
+#the library functions can be instrumented unconditionally.
+
+_local = threading.local()
+
+def current():
+    """the active Request in this thread, or None"""
+    return getattr(_local, 'request', None)
+
+@contextlib.contextmanager
+def stage(name):
+    """time the enclosed block as stage name of the current request"""
+    req = current()
+    if req is None:
+        yield
+        return
+    req.nested.append(0.0)
+    st = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter()-st
+        nested = req.nested.pop()
+        req.stages[name] = req.stages.get(name, 0.0) + elapsed - nested
+        if req.nested:
+            req.nested[-1] += elapsed
+
+def count(name, num):
+    """add num to counter name of the current request"""
+    req = current()
+    if req is not None:
+        req.counts[name] = req.counts.get(name, 0) + num
+
+def count_iter(items, name):
+    """pass through items, counting them as name"""
+    for item in items:
+        count(name, 1)
+        yield item
+
+
+def _exp_buckets(start, factor, num):
+    return [start*factor**i for i in range(num)]
+
+time_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+count_buckets = _exp_buckets(1, 10, 7)
+byte_buckets = _exp_buckets(1024, 4, 10)
+
+
+def _format_value(val):
+    if val == float('inf'):
+        return '+Inf'
+    if isinstance(val, float) and val.is_integer():
+        return str(int(val))
+    return repr(val)
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k,v in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Histogram:
+    """cumulative histogram in the prometheus style, one set of buckets for
+each combination of label values"""
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            if not label_values in self.values:
+                self.values[label_values] = [[0]*(len(self.buckets)+1), 0.0, 0]
+            counts, _, _ = vals = self.values[label_values]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            vals[1] += value
+            vals[2] += 1
+
+    def exposition(self):
+        """lines of prometheus text format"""
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            for label_values, (counts, total, num) in sorted(self.values.items()):
+                cumulative = 0
+                for le, c in zip(self.buckets + [float('inf')], counts):
+                    cumulative += c
+                    lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labels, label_values, ('le', _format_value(le))), cumulative))
+                lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labels, label_values), _format_value(total)))
+                lines.append('%s_count%s %d' % (self.name, _format_labels(self.labels, label_values), num))
+        return lines
+
+
+class Request:
+    """stage times and counts for one request"""
+
+    def __init__(self, route):
+        self.route = route
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counts = {}
+        self.nested = []
+        self.response_bytes = 0
+
+    @contextlib.contextmanager
+    def activate(self):
+        """make this the current request in this thread"""
+        prev = current()
+        _local.request = self
+        try:
+            yield self
+        finally:
+            _local.request = prev
+
+    def server_timing(self):
+        """Server-Timing header value for the stages so far, in ms"""
+        return ", ".join("%s;dur=%.2f" % (k, v*1000) for k,v in self.stages.items())
+
+
+class Metrics:
+    """histograms of request times, stage times, rows read, elements
+returned and response sizes, by route
+
+Example:
+    >>> req = metrics.start('map')
+    >>> with req.activate():
+    ...     eles = list(data.iter_elements(box))
+    ...     with stage('serialize'):
+    ...         resp = make_osm_xml(eles)
+    >>> req.response_bytes = len(resp)
+    >>> metrics.finish(req)
+    >>> print(metrics.exposition())
+"""
+
+    def __init__(self, prefix='simpleosmapi'):
+        self.request_seconds = Histogram(prefix+'_request_seconds', 'time taken to respond to each request', time_buckets, ('route',))
+        self.stage_seconds = Histogram(prefix+'_stage_seconds', 'time taken by each stage of a request', time_buckets, ('route', 'stage'))
+        self.rows = Histogram(prefix+'_request_rows', 'rows read from the database for each request', count_buckets, ('route',))
+        self.elements = Histogram(prefix+'_request_elements', 'elements returned or uploaded by each request', count_buckets, ('route',))
+        self.response_bytes = Histogram(prefix+'_response_bytes', 'size of each response', byte_buckets, ('route',))
+
+    def start(self, route):
+        return Request(route)
+
+    def finish(self, req):
+        """record the stages and counts of a completed request"""
+        self.request_seconds.observe(time.perf_counter()-req.start, req.route)
+        for name, secs in req.stages.items():
+            self.stage_seconds.observe(secs, req.route, name)
+        if 'rows' in req.counts:
+            self.rows.observe(req.counts['rows'], req.route)
+        if 'elements' in req.counts:
+            self.elements.observe(req.counts['elements'], req.route)
+        self.response_bytes.observe(req.response_bytes, req.route)
+
+    def exposition(self):
+        """all metrics in prometheus text format"""
+        lines = []
+        for hist in (self.request_seconds, self.stage_seconds, self.rows, self.elements, self.response_bytes):
+            lines.extend(hist.exposition())
+        return "\n".join(lines) + "\n"
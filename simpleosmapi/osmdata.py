@@ -1,17 +1,38 @@
 from .elements import WithBbox, Node, Way, Relation, Changeset, element_key, element_change_key
 from .xml import ET, read_osm_xml, read_osm_change_xml, _mkint
-from .database import make_sqlite, _iter_elements, _make_changeset, _make_ele_curs
-import time
+from .database import make_sqlite, get_meta, _iter_elements, _make_changeset, _make_ele_curs, _node_locations, _fetch_elements, _fetch_versions, _fetch_history, _fetch_full, _parent_relations, _update_relation_boxes, _node_ways, _update_way_boxes
+from .codec import get_codec
+from .changes import plan_changes
+from .metrics import stage
+import time, threading, queue, functools, contextlib
 
 
 def timestamp():
     """current time in the expected osm format"""
     return time.strftime("%Y-%m-%dT%H:%M:%SZ") 
 
+def _locked(func):
+    """hold the OsmData write lock while calling func"""
+    @functools.wraps(func)
+    def call(self, *args, **kwargs):
+        with self.write_lock:
+            return func(self, *args, **kwargs)
+    return call
+
 class OsmData:
     """
 Represents a database of osm elements, backed by a sqlite connection.
 
+All changes are made through a single writer connection, guarded by a
+lock. Reads through iter_elements use a pool of read only connections, so
+that they can run in other threads alongside writes. The database is
+switched to WAL mode, so readers don't block the writer and vice versa.
+
+Changesets are stored as soon as they are opened, and new ids are read
+from the database at the start of each write transaction, so several
+OsmData objects (e.g. in different processes) can share one file. Objects
+opened with readonly=True only serve reads.
+
 Data can be read using the elements_iter member function, equivilant
 to an GET /api/0.6/map call.
 
@@ -29,19 +50,40 @@ Example:
     
 """
 
-    def __init__(self, fn, uid, user):
+    def __init__(self, fn, uid, user, num_readers=4, journal_mode='wal', synchronous='full', readonly=False):
         """
 Args:
     filename (str): filename of existing sqlite database. Call make_sqlite
 to create new database
     uid (int): user id for new changesets
     user (str): user name for new changesets.
+    num_readers (int): maximum number of read only connections
+    journal_mode (str): sqlite journal_mode, 'wal' is needed for reads to
+run alongside writes
+    synchronous (str): sqlite synchronous setting. With 'full' each upload
+is synced to disk once when committed, with 'normal' (and journal_mode
+'wal') commits are only synced at checkpoints.
+    readonly (bool): open the main connection read only, and don't add the
+user. Calls which change the database will fail.
 """
         self.filename = fn
         self.uid = uid
         self.username = user
         
-        self.conn = make_sqlite(self.filename)
+        self.readonly = readonly
+        self.write_lock = threading.RLock()
+        self.conn = make_sqlite(self.filename, readonly=readonly, check_same_thread=False, journal_mode=journal_mode, synchronous=synchronous)
+        self.transaction_depth = 0
+        
+        #called as listener(bbox, changes) after each upload is committed,
+        #see ResponseCache.invalidate
+        self.listeners = []
+        
+        self.num_readers = num_readers
+        self.readers = queue.LifoQueue()
+        self.readers_opened = 0
+        self.readers_lock = threading.Lock()
+        self.codec = get_codec(get_meta(self.conn, 'codec', 'json'))
        
         self.curs = self.conn.cursor()
         self.curs.execute("select * from changesets")
@@ -56,27 +98,31 @@ to create new database
         for row in self.curs:
             self.users[row[0]] = row[1]
     
-        if not uid in self.users:
+        if not uid in self.users and not readonly:
             print("new user %d %s" % (uid,user))
             self.curs.execute("insert into users values (?, ?)", (uid, user))
             self.users[uid]=user
             
-        if self.users[uid]!=user:
+        if self.users.get(uid, user)!=user and not readonly:
             print("rename user %d from %s to %s" % (uid, self.users[uid], user))
             self.curs.execute("alter users set displayname=? where id=?", (user,uid))
             self.users[uid]=user
         
-        if not self.changesets:
-            self.next_ids = {'changeset':1,'node':1,'way':1,'relation':1}
-        else:
-            self.next_ids = {'changeset': max(self.changesets)+1}
-            for ty in ('node','way','relation'):
-                (curr,), = self.curs.execute("select max(id) from "+ty)
-                self.next_ids[ty] = 1 if curr is None else curr+1
+        self._load_next_ids()
         print("have %d changesets, next_ids: %s" % (len(self.changesets), self.next_ids))
     
-        self.in_transaction=False
+    def _load_next_ids(self):
+        #bulk loaded elements may belong to changesets not in the changesets table
+        (curr,), = self.curs.execute("select max(id) from changesets")
+        max_changeset = max(curr or 0, int(get_meta(self.conn, 'max_changeset', 0)))
+        self.next_ids = {'changeset': max_changeset+1}
+        for ty in ('node','way','relation'):
+            #every element has one current row, so this only reads the index
+            (curr,), = self.curs.execute("select max(id) from "+ty+" where current=1")
+            self.next_ids[ty] = 1 if curr is None else curr+1
+
     
+    @_locked
     def next_changeset(self):
         """start new changeset
 
@@ -86,10 +132,14 @@ Returns:
     Changeset object
 """
 
-        cid = self.next_id('changeset')
-        self.changesets[cid] = Changeset(cid,self.username,self.uid,timestamp(),{},None,True)
-        return self.changesets[cid]
+        with self.transaction():
+            cid = self.next_id('changeset')
+            chg = Changeset(cid,self.username,self.uid,timestamp(),{},None,True)
+            chg.insert(self.curs)
+        self.changesets[cid] = chg
+        return chg
     
+    @_locked
     def add_changeset_tags(self, cid, tags):
         """add tags to given changeset
 
@@ -103,12 +153,15 @@ Returns:
 """
 
 
-        chg = self.changesets[cid]
-        for k,v in tags.items():
-            chg.tags[k]=v
+        with self.transaction():
+            chg = self.get_changeset(cid)
+            for k,v in tags.items():
+                chg.tags[k]=v
+            chg.insert(self.curs)
         
         return chg
         
+    @_locked
     def close_changeset(self, cid):
         """finalize changeset
 
@@ -118,13 +171,40 @@ Args:
     cid (int): Changeset id
 """
         
-        chg=self.changesets[cid]
-        chg.active=False
-        chg.insert(self.curs)
+        with self.transaction():
+            chg=self.get_changeset(cid)
+            chg.active=False
+            chg.insert(self.curs)
         
             
         
     
+    @_locked
+    def get_changeset(self, cid):
+        """fetch changeset, as currently stored in the database
+
+Args:
+    cid (int): Changeset id
+Returns:
+    Changeset object, or None if there is no changeset cid
+"""
+        rows = list(self.curs.execute("select * from changesets where id=?", (cid,)))
+        if not rows:
+            return self.changesets.get(cid)
+        self.changesets[cid] = _make_changeset(rows[0])
+        return self.changesets[cid]
+    
+    @_locked
+    def load_changesets(self):
+        """fetch all changesets from the database
+
+Returns:
+    list of Changeset objects
+"""
+        self.changesets = dict((row[0], _make_changeset(row)) for row in self.curs.execute("select * from changesets"))
+        return list(self.changesets.values())
+    
+    @_locked
     def find_ele(self, ty, id_):
         """fetch object of given type and id
 
@@ -140,49 +220,112 @@ Returns:
     
     
     
-    def calc_boxes(self, way):
+    def calc_boxes(self, way, locations=None):
+        """set way bbox from the locations of its nodes
+
+Args:
+    way (Way): way object
+    locations (dict): {node_id: (lon, lat)} of nodes already known, any
+other nodes are fetched in a single query and added to locations.
+Returns:
+    list of (lon, lat) node locations
+"""
+        if locations is None:
+            locations = {}
+        
+        missing = [n for n in way.refs if not n in locations]
+        if missing:
+            found = _node_locations(self.curs, missing)
+            for n in missing:
+                locations[n] = found.get(n)
         
         nn = []
         for n in way.refs:
-            e = self.find_ele('node',n)
-            if not e:
+            loc = locations[n]
+            if loc is None:
                 print('missing node %d' % (n,))
             else:
-                nn.append(e)
-        for n in nn:
-            way.expand_bbox([n.lon,n.lat,n.lon,n.lat])
+                nn.append(loc)
+        for lon,lat in nn:
+            way.expand_bbox([lon,lat,lon,lat])
         
-        for n in nn:
-            n.expand_bbox(way.bbox)
-            
         return nn
     
     def start_transaction(self):
-        """start transaction on internal sqlite connection"""
-        pass
-        #if self.in_transaction:
-        #    self.curs.execute("commit")
-            
-        #self.curs.execute("begin")
-        #self.in_transaction=True
+        """start transaction on internal sqlite connection. If a transaction
+is already open, start a savepoint within it instead.
+
+Holds the write lock until the matching finish_transaction call."""
+        self.write_lock.acquire()
+        try:
+            if self.transaction_depth==0:
+                self.curs.execute("begin immediate")
+                try:
+                    #another connection may have added elements since the last transaction
+                    self._load_next_ids()
+                except:
+                    self.curs.execute("rollback")
+                    raise
+            else:
+                self.curs.execute("savepoint sp%d" % self.transaction_depth)
+        except:
+            #e.g. database is locked: leave no transaction open, and the lock free
+            self.write_lock.release()
+            raise
+        self.transaction_depth+=1
     
-    def finish_transaction(self):
-        """finish transaction on internal sqlite connection"""
-        
-        pass
-        #if not self.in_transaction:
-        #    return
-        #self.curs.execute("commit")
-        #self.in_transaction=False
+    def finish_transaction(self, rollback=False):
+        """finish transaction (or savepoint) on internal sqlite connection
+started by start_transaction
+
+Args:
+    rollback (bool): discard changes rather than commit them
+"""
+        if self.transaction_depth==0:
+            return
+        self.transaction_depth-=1
+        try:
+            if self.transaction_depth==0:
+                self.curs.execute("rollback" if rollback else "commit")
+            else:
+                sp = "sp%d" % self.transaction_depth
+                if rollback:
+                    self.curs.execute("rollback to "+sp)
+                self.curs.execute("release "+sp)
+        finally:
+            self.write_lock.release()
+    
+    @property
+    def in_transaction(self):
+        return self.transaction_depth>0
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        """context manager calling start_transaction, then
+finish_transaction on exit, rolling back if an exception was raised.
+May be nested, using savepoints.
+
+Example:
+    >>> with data.transaction():
+    ...     data.add_ele(chg.id, 'create', Node(...), {})
+"""
+        self.start_transaction()
+        try:
+            yield
+        except:
+            self.finish_transaction(True)
+            raise
+        self.finish_transaction()
     
+    @_locked
     def save(self):
         """finalize any open changesets, and finish transaction on
 internal sqlite connection"""
-        for k,v in self.changesets.items():
-            if v.active:
-                v.active=False
-                v.insert(self.curs)
-        self.finish_transaction()
+        with self.transaction():
+            for k,v in self.changesets.items():
+                if v.active:
+                    v.active=False
+                    v.insert(self.curs)
         
     
     def next_id(self, ty):
@@ -203,7 +346,8 @@ Returns:
     
        
     
-    def add_ele(self, changeset_id, change_type, element, replacement_ids):
+    @_locked
+    def add_ele(self, changeset_id, change_type, element, replacement_ids, locations=None):
         """add element to the database
 
 In all cases the element user and uid are replaced the with values given
@@ -218,11 +362,15 @@ delete: set any existing objects with given id to be invisible
 Created element ids are added to replacement_ids {(type,placeholder_id):new_id}.
 This is used to replace the placeholder ids in way refs and relation members.
 
+If given, locations {node_id: (lon, lat)} is used to calculate way bboxes
+(see calc_boxes), and is updated with the location of each node added.
+
 Args:
     changeset_id (int): changeset
     change_type (str): 'create', 'modify' or 'delete'
     element (Node, Way or Relation): element
     replacement_ids (dict): see above
+    locations (dict): see above
 Returns:
     tuple of (element_type,
         {'old_id': int, 'new_id': int, 'new_version: int} (as appropiate),
@@ -258,10 +406,11 @@ Returns:
             
             element.version=1
             
-            if element.type=='way': self.calc_boxes(element)
-            element.insert(self.curs)
+            if element.type=='way': self.calc_boxes(element, locations)
+            element.insert(self.curs, codec=self.codec)
+            self._update_location(element, locations)
             
-            self.changesets[changeset_id].expand_bbox(element.bbox)
+            self.changesets[changeset_id].expand_bbox(element.extent)
             
             return (element.type, {'old_id': old_id,'new_id':element.id,'new_version': element.version},None,None)
             
@@ -270,10 +419,12 @@ Returns:
             old_ele=self.find_ele(element.type,element.id)
             element.version = 1 if old_ele is None else old_ele.version+1
             
-            if element.type=='way': self.calc_boxes(element)
-            element.insert(self.curs)
+            if element.type=='way': self.calc_boxes(element, locations)
+            element.insert(self.curs, codec=self.codec)
+            self._update_location(element, locations)
             
-            self.changesets[changeset_id].expand_bbox(element.bbox)
+            self.changesets[changeset_id].expand_bbox(element.extent)
+            if old_ele is not None: self.changesets[changeset_id].expand_bbox(old_ele.extent)
             return (element.type, {'old_id': element.id,'new_id':element.id,'new_version': element.version},None,None)
         
         elif change_type=='delete':
@@ -281,54 +432,185 @@ Returns:
             old_ele=self.find_ele(element.type,element.id)
             element.version = 1 if old_ele is None else old_ele.version+1
             
-            element.insert(self.curs)
+            element.insert(self.curs, codec=self.codec)
+            self._update_location(element, locations)
+            
+            if old_ele is not None: self.changesets[changeset_id].expand_bbox(old_ele.extent)
             return (element.type, {'old_id': element.id},None,None)
         else:
             raise Exception('wrong change_type %s' % repr(change_type))
     
+    def _update_location(self, element, locations):
+        if locations is None or element.type!='node':
+            return
+        locations[element.id] = (element.lon,element.lat) if element.visible else None
+    
+    @_locked
     def add_changeset_data(self, cid, elements):
         """add elements to database
 
-Calls add_ele for each element in elements"""
-        self.start_transaction()
+Calls add_ele for each element in elements, within a single transaction.
+The elements are first ordered with plan_changes, so that each is added
+after any elements it refers to. The boxes of ways and relations whose
+nodes or members changed are then recalculated, finding the ways using
+each node from the way_node table. If any element fails the whole
+transaction is rolled back. Once committed, each of self.listeners is
+called with the changeset bbox and a list of (type, id, members) for the
+changed elements.
+
+Args:
+    cid (int): changeset id
+    elements (list): tuples of change type and element, as yielded by
+read_osm_change_xml
+Returns:
+    list of add_ele results
+"""
         response_data = []
         repls = {}
-        elements.sort(key=element_change_key)
+        with stage('plan'):
+            elements = plan_changes(elements)
         
-        self.curs.execute("begin")
-        pp=[]
-        for ty, ele in elements:
-            try:
-                response_data.append(self.add_ele(cid, ty, ele, repls))
-            except:
-                pp.append((ty,ele))
+        with stage('write'), self.transaction():
+            chg = self.get_changeset(cid)
+            if chg is None:
+                raise Exception("changeset %d doesn't exist" % cid)
+            #fetch the location of every existing node used by the uploaded ways
+            #at once, nodes added by this upload are filled in by add_ele
+            way_refs = set(n for ty,ele in elements if ele.type=='way' and ty!='delete' for n in ele.refs if n>0)
+            locations = _node_locations(self.curs, way_refs)
+            
+            for ty,ele in elements:
+                response_data.append(self.add_ele(cid, ty, ele, repls, locations))
+            with stage('boxes'):
+                self._update_boxes(elements)
+            chg.insert(self.curs)
         
+        changes = [(ele.type, ele.id, ele.members if ele.type=='relation' else None) for ty,ele in elements]
+        for listener in self.listeners:
+            listener(self.changesets[cid].bbox, changes)
         
-        for i in range(5):
-            if pp:
-                print('pass %d: have %d problems' % (i,len(pp)))
-                qq=[]
-                for ty,ele in pp:
-                    try:
-                        response_data.append(self.add_ele(cid, ty, ele, repls))
-                    except:
-                        qq.append((ty,ele))
-                
-                pp=qq
-        self.curs.execute("commit")
-        if pp:
-            print('still have %d problems' % len(pp))
-            print(pp)
-            raise Exception("failed")
-        
-        self.finish_transaction()
         print(response_data)
         return response_data
         
     
+    def _update_boxes(self, elements):
+        #add_ele sets the boxes of the ways uploaded. Those of other ways
+        #using changed nodes are recalculated, then the boxes of the
+        #relations added and of every relation containing a changed element,
+        #with changes passed on to the relations containing them
+        changed = set((ele.type[0], ele.id) for ty,ele in elements)
+        ways = _node_ways(self.curs, [i for t,i in changed if t=='n'])
+        ways = _update_way_boxes(self.curs, [i for i in ways if not ('w',i) in changed])
+        changed.update(('w',i) for i in ways)
+        
+        rels = _parent_relations(self.curs, changed)
+        rels.update(ele.id for ty,ele in elements if ele.type=='relation' and ty!='delete')
+        return len(ways) + _update_relation_boxes(self.curs, rels)
+    
+    def _get_reader(self):
+        try:
+            return self.readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self.readers_lock:
+            if self.readers_opened < self.num_readers:
+                self.readers_opened += 1
+                return make_sqlite(self.filename, readonly=True, check_same_thread=False)
+        return self.readers.get()
+    
+    def _put_reader(self, conn):
+        self.readers.put(conn)
+    
+    @contextlib.contextmanager
+    def _reading(self):
+        #cursor on one of the read only connections, within a transaction so
+        #that all queries read from the same snapshot
+        conn = self._get_reader()
+        try:
+            conn.execute("begin")
+            yield conn.cursor()
+        finally:
+            conn.execute("rollback")
+            self._put_reader(conn)
+    
     def iter_elements(self, box=None):
+        """iterate over current elements in the given box, equivilant to
+GET /api/0.6/map. Uses one of the read only connections. For a box the
+elements are all read before the first is yielded, and the connection
+returned, so it isn't held while a response is sent. With box=None the
+connection is held until the iterator is exhausted or closed.
+
+Args:
+    box (list): [minlon, minlat, maxlon, maxlat] in degrees, or None for
+all elements
+Yields:
+    Node, Way and Relation objects
+"""
+        if box is None:
+            with self._reading() as curs:
+                yield from _iter_elements(curs, box)
+            return
         
-        return _iter_elements(self.curs, box)
+        with self._reading() as curs:
+            eles = _iter_elements(curs, box)
+        yield from eles
+    
+    def get_elements(self, ty, ids):
+        """fetch the current versions of elements of one type, including
+deleted elements, equivilant to GET /api/0.6/nodes?nodes=...
+
+Args:
+    ty (str): 'node', 'way' or 'relation'
+    ids (iterable): element ids
+Returns:
+    list of Node, Way or Relation objects ordered by id, missing elements
+are skipped
+"""
+        with self._reading() as curs:
+            return _fetch_elements(curs, ty, ids, visible_only=False)
+    
+    def get_versions(self, ty, versions):
+        """fetch given versions of elements of one type, equivilant to
+GET /api/0.6/node/<id>/<version>, or GET /api/0.6/nodes?nodes=<id>v<version>,...
+
+Args:
+    ty (str): 'node', 'way' or 'relation'
+    versions (iterable): (id, version) pairs
+Returns:
+    list of Node, Way or Relation objects ordered by id and version,
+missing versions are skipped
+"""
+        with self._reading() as curs:
+            return _fetch_versions(curs, ty, versions)
+    
+    def get_full(self, ty, id_):
+        """fetch a way or relation with all the elements it refers to,
+equivilant to GET /api/0.6/way/<id>/full. Member relations are included
+with their own members, to any depth.
+
+Args:
+    ty (str): 'way' or 'relation'
+    id (int): element id
+Returns:
+    list of Node, Way and Relation objects, empty if the element is missing
+or deleted
+"""
+        with self._reading() as curs:
+            return _fetch_full(curs, ty, id_)
+    
+    def get_history(self, ty, id_):
+        """fetch all versions of an element, equivilant to
+GET /api/0.6/node/<id>/history
+
+Args:
+    ty (str): 'node', 'way' or 'relation'
+    id (int): element id
+Returns:
+    list of Node, Way or Relation objects ordered by version, empty if the
+element doesn't exist
+"""
+        with self._reading() as curs:
+            return _fetch_history(curs, ty, id_)
         
         
 
@@ -0,0 +1,443 @@
+from .elements import Node, Way, Relation
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from itertools import accumulate
+import struct, zlib, lzma, io, os, time, calendar, functools
+
+#osm pbf files are a sequence of blobs, each a 4 byte length, a BlobHeader
+#message and a Blob message. The first blob is an OSMHeader, the rest are
+#OSMData blobs holding a PrimitiveBlock. See
+#https://wiki.openstreetmap.org/wiki/PBF_Format for the message definitions.
+
+_supported_features = set(['OsmSchema-V0.6', 'DenseNodes', 'HistoricalInformation'])
+_member_types = ['node', 'way', 'relation']
+_member_type_nums = {'node': 0, 'way': 1, 'relation': 2}
+_timestamp_format = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def _read_varint(data, pos):
+    result, shift = 0, 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def _iter_fields(data):
+    """yields field number and value for each field in a message. Length
+delimited values are returned as bytes, fixed size values are skipped."""
+    pos, end = 0, len(data)
+    while pos < end:
+        key, pos = _read_varint(data, pos)
+        fn, wt = key >> 3, key & 7
+        if wt == 0:
+            val, pos = _read_varint(data, pos)
+        elif wt == 2:
+            ln, pos = _read_varint(data, pos)
+            val = data[pos:pos+ln]
+            pos += ln
+        elif wt == 1:
+            pos += 8
+            continue
+        elif wt == 5:
+            pos += 4
+            continue
+        else:
+            raise Exception("unsupported wire type %d" % wt)
+        yield fn, val
+
+def _unpack_varints(data):
+    vals = []
+    result, shift = 0, 0
+    for b in data:
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            vals.append(result)
+            result, shift = 0, 0
+        else:
+            shift += 7
+    return vals
+
+def _sint(val):
+    return (val >> 1) ^ -(val & 1)
+
+def _unzigzag(vals):
+    return [(v >> 1) ^ -(v & 1) for v in vals]
+
+def _unpack_deltas(data):
+    return list(accumulate(_unzigzag(_unpack_varints(data))))
+
+def _int64(val):
+    return val - (1<<64) if val >= (1<<63) else val
+
+
+def _varint(val):
+    if val < 0:
+        val += 1<<64
+    out = bytearray()
+    while val > 0x7f:
+        out.append((val & 0x7f) | 0x80)
+        val >>= 7
+    out.append(val)
+    return bytes(out)
+
+def _zigzag(val):
+    return val*2 if val >= 0 else -val*2-1
+
+def _pack_varints(vals):
+    return b"".join(map(_varint, vals))
+
+def _pack_deltas(vals):
+    prev = 0
+    out = []
+    for v in vals:
+        out.append(_varint(_zigzag(v-prev)))
+        prev = v
+    return b"".join(out)
+
+def _field_varint(fn, val):
+    return _varint(fn << 3) + _varint(val)
+
+def _field_bytes(fn, val):
+    return _varint((fn << 3) | 2) + _varint(len(val)) + val
+
+
+@functools.lru_cache(maxsize=1<<16)
+def _timestamp_str(secs):
+    return time.strftime(_timestamp_format, time.gmtime(secs))
+
+@functools.lru_cache(maxsize=1<<16)
+def _timestamp_secs(timestamp):
+    return calendar.timegm(time.strptime(timestamp, _timestamp_format))
+
+
+def _blob_data(blob):
+    for fn, val in _iter_fields(blob):
+        if fn == 1:
+            return val
+        if fn == 3:
+            return zlib.decompress(val)
+        if fn == 4:
+            return lzma.decompress(val)
+    raise Exception("unsupported blob compression")
+
+def _iter_blobs(obj):
+    while True:
+        head = obj.read(4)
+        if not head:
+            return
+        if len(head) < 4:
+            raise Exception("truncated pbf file")
+        size, = struct.unpack('>I', head)
+        blob_type, data_size = None, 0
+        for fn, val in _iter_fields(obj.read(size)):
+            if fn == 1:
+                blob_type = val.decode('utf-8')
+            elif fn == 3:
+                data_size = val
+        blob = obj.read(data_size)
+        if len(blob) < data_size:
+            raise Exception("truncated pbf file")
+        yield blob_type, blob
+
+def _check_header(blob):
+    for fn, val in _iter_fields(_blob_data(blob)):
+        if fn == 4:
+            feature = val.decode('utf-8')
+            if not feature in _supported_features:
+                raise Exception("unsupported pbf feature %s" % feature)
+
+
+class _Block:
+    #decodes the contents of one PrimitiveBlock
+    def __init__(self, data):
+        self.strings = ['']
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset, self.lon_offset = 0, 0
+        self.date_granularity = 1000
+
+        for fn, val in _iter_fields(data):
+            if fn == 1:
+                self.strings = [s.decode('utf-8') for f,s in _iter_fields(val) if f == 1]
+            elif fn == 2:
+                self.groups.append(val)
+            elif fn == 17:
+                self.granularity = val
+            elif fn == 18:
+                self.date_granularity = val
+            elif fn == 19:
+                self.lat_offset = _int64(val)
+            elif fn == 20:
+                self.lon_offset = _int64(val)
+
+    def elements(self):
+        eles = []
+        for group in self.groups:
+            for fn, val in _iter_fields(group):
+                if fn == 1:
+                    eles.append(self.node(val))
+                elif fn == 2:
+                    eles.extend(self.dense(val))
+                elif fn == 3:
+                    eles.append(self.way(val))
+                elif fn == 4:
+                    eles.append(self.relation(val))
+        return eles
+
+    def coord(self, offset, val):
+        #stored as integer 1e-7 degrees, pbf values are nanodegrees
+        return (offset + self.granularity*val + 50) // 100
+
+    def timestamp(self, val):
+        if not val:
+            return None
+        return _timestamp_str(val*self.date_granularity // 1000)
+
+    def tags(self, keys, vals):
+        st = self.strings
+        return dict((st[k], st[v]) for k,v in zip(_unpack_varints(keys), _unpack_varints(vals)))
+
+    def info(self, data):
+        version, timestamp, changeset, uid, user, visible = None, 0, None, None, 0, True
+        if data is not None:
+            for fn, val in _iter_fields(data):
+                if fn == 1: version = val
+                elif fn == 2: timestamp = val
+                elif fn == 3: changeset = val
+                elif fn == 4: uid = val
+                elif fn == 5: user = val
+                elif fn == 6: visible = bool(val)
+        return changeset, version, self.timestamp(timestamp), self.strings[user] or None, uid, visible
+
+    def _common(self, data, signed_id=False):
+        #the id of a Node message is a sint64, for ways and relations an int64
+        id, keys, vals, info, rest = 0, b'', b'', None, {}
+        for fn, val in _iter_fields(data):
+            if fn == 1: id = _sint(val) if signed_id else _int64(val)
+            elif fn == 2: keys = val
+            elif fn == 3: vals = val
+            elif fn == 4: info = val
+            else: rest[fn] = val
+        changeset, version, timestamp, user, uid, visible = self.info(info)
+        return (id, changeset, version, timestamp, user, uid, self.tags(keys, vals), visible), rest
+
+    def node(self, data):
+        common, rest = self._common(data, True)
+        lat, lon = _sint(rest.get(8, 0)), _sint(rest.get(9, 0))
+        return Node(*common, self.coord(self.lon_offset, lon), self.coord(self.lat_offset, lat))
+
+    def way(self, data):
+        common, rest = self._common(data)
+        return Way(*common, _unpack_deltas(rest.get(8, b'')))
+
+    def relation(self, data):
+        common, rest = self._common(data)
+        roles = _unpack_varints(rest.get(8, b''))
+        refs = _unpack_deltas(rest.get(9, b''))
+        types = _unpack_varints(rest.get(10, b''))
+        st = self.strings
+        members = [{'type': _member_types[t], 'ref': r, 'role': st[s]} for t,r,s in zip(types, refs, roles)]
+        return Relation(*common, members)
+
+    def dense(self, data):
+        ids, lats, lons, keys_vals, info = [], [], [], [], None
+        for fn, val in _iter_fields(data):
+            if fn == 1: ids = _unpack_deltas(val)
+            elif fn == 5: info = val
+            elif fn == 8: lats = _unpack_deltas(val)
+            elif fn == 9: lons = _unpack_deltas(val)
+            elif fn == 10: keys_vals = _unpack_varints(val)
+
+        n = len(ids)
+        versions, timestamps, changesets, uids, users, visibles = [None]*n, [0]*n, [None]*n, [None]*n, [0]*n, [True]*n
+        if info is not None:
+            for fn, val in _iter_fields(info):
+                if fn == 1: versions = _unpack_varints(val)
+                elif fn == 2: timestamps = _unpack_deltas(val)
+                elif fn == 3: changesets = _unpack_deltas(val)
+                elif fn == 4: uids = _unpack_deltas(val)
+                elif fn == 5: users = _unpack_deltas(val)
+                elif fn == 6: visibles = [bool(v) for v in _unpack_varints(val)]
+
+        st = self.strings
+        tags = [{} for i in range(n)]
+        if keys_vals:
+            i, j = 0, 0
+            while j < len(keys_vals) and i < n:
+                k = keys_vals[j]
+                if k == 0:
+                    i += 1
+                    j += 1
+                else:
+                    tags[i][st[k]] = st[keys_vals[j+1]]
+                    j += 2
+
+        return [Node(id, cs, vs, self.timestamp(ts), st[us] or None, ui, tg, vi,
+                    self.coord(self.lon_offset, ln), self.coord(self.lat_offset, lt))
+                for id, cs, vs, ts, us, ui, tg, vi, ln, lt
+                in zip(ids, changesets, versions, timestamps, users, uids, tags, visibles, lons, lats)]
+
+
+def _decode_block(blob):
+    return _Block(_blob_data(blob)).elements()
+
+
+def read_pbf(source, num_workers=None):
+    """read osm elements from an osm pbf file. Blocks are decoded in
+parallel by a pool of num_workers processes, and the elements yielded in
+the order they appear in the file.
+
+Args:
+    source (str, bytes or file object): filename, pbf data, or binary file
+object
+    num_workers (int): number of decoding processes, defaults to the number
+of cpus. If 0 blocks are decoded in this process.
+Yields:
+    Node, Way or Relation objects
+"""
+    if isinstance(source, str):
+        with open(source, 'rb') as obj:
+            yield from read_pbf(obj, num_workers)
+        return
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+
+    def data_blobs():
+        for blob_type, blob in _iter_blobs(source):
+            if blob_type == 'OSMHeader':
+                _check_header(blob)
+            elif blob_type == 'OSMData':
+                yield blob
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    if num_workers == 0:
+        for blob in data_blobs():
+            yield from _decode_block(blob)
+        return
+
+    with ProcessPoolExecutor(num_workers) as pool:
+        pending = deque()
+        for blob in data_blobs():
+            pending.append(pool.submit(_decode_block, blob))
+            if len(pending) >= 2*num_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+class _StringTable:
+    def __init__(self):
+        self.strings = ['']
+        self.index = {'': 0}
+
+    def __call__(self, val):
+        idx = self.index.get(val)
+        if idx is None:
+            idx = self.index[val] = len(self.strings)
+            self.strings.append(val)
+        return idx
+
+    def encode(self):
+        return b"".join(_field_bytes(1, s.encode('utf-8')) for s in self.strings)
+
+def _secs(timestamp):
+    return _timestamp_secs(timestamp) if timestamp else 0
+
+def _encode_info(ele, st, historical):
+    parts = []
+    if ele.version is not None: parts.append(_field_varint(1, ele.version))
+    if ele.timestamp: parts.append(_field_varint(2, _secs(ele.timestamp)))
+    if ele.changeset is not None: parts.append(_field_varint(3, ele.changeset))
+    if ele.uid is not None: parts.append(_field_varint(4, ele.uid))
+    if ele.user: parts.append(_field_varint(5, st(ele.user)))
+    if historical: parts.append(_field_varint(6, 1 if ele.visible else 0))
+    return b"".join(parts)
+
+def _encode_common(ele, st, historical):
+    keys = [st(k) for k in ele.tags]
+    vals = [st(v) for v in ele.tags.values()]
+    return (_field_varint(1, ele.id) + _field_bytes(2, _pack_varints(keys)) + _field_bytes(3, _pack_varints(vals))
+        + _field_bytes(4, _encode_info(ele, st, historical)))
+
+def _encode_dense(eles, st, historical):
+    keys_vals = []
+    for e in eles:
+        for k,v in e.tags.items():
+            keys_vals.append(st(k))
+            keys_vals.append(st(v))
+        keys_vals.append(0)
+
+    info = [_field_bytes(1, _pack_varints([e.version or 0 for e in eles])),
+        _field_bytes(2, _pack_deltas([_secs(e.timestamp) for e in eles])),
+        _field_bytes(3, _pack_deltas([e.changeset or 0 for e in eles])),
+        _field_bytes(4, _pack_deltas([e.uid or 0 for e in eles])),
+        _field_bytes(5, _pack_deltas([st(e.user) if e.user else 0 for e in eles]))]
+    if historical:
+        info.append(_field_bytes(6, _pack_varints([1 if e.visible else 0 for e in eles])))
+
+    return b"".join([_field_bytes(1, _pack_deltas([e.id for e in eles])),
+        _field_bytes(5, b"".join(info)),
+        _field_bytes(8, _pack_deltas([e.lat or 0 for e in eles])),
+        _field_bytes(9, _pack_deltas([e.lon or 0 for e in eles])),
+        _field_bytes(10, _pack_varints(keys_vals))])
+
+def _encode_block(eles, historical):
+    st = _StringTable()
+    ty = eles[0].type
+    if ty == 'node':
+        group = _field_bytes(2, _encode_dense(eles, st, historical))
+    elif ty == 'way':
+        group = b"".join(_field_bytes(3, _encode_common(e, st, historical) + _field_bytes(8, _pack_deltas(e.refs))) for e in eles)
+    else:
+        group = b"".join(_field_bytes(4, _encode_common(e, st, historical)
+                + _field_bytes(8, _pack_varints([st(m['role']) for m in e.members]))
+                + _field_bytes(9, _pack_deltas([int(m['ref']) for m in e.members]))
+                + _field_bytes(10, _pack_varints([_member_type_nums[m['type']] for m in e.members])))
+            for e in eles)
+    #granularity and date_granularity are left at their defaults of 100
+    #nanodegrees and 1000 milliseconds
+    return _field_bytes(1, st.encode()) + _field_bytes(2, group)
+
+def _encode_blob(blob_type, data, compress):
+    if compress:
+        blob = _field_varint(2, len(data)) + _field_bytes(3, zlib.compress(data))
+    else:
+        blob = _field_bytes(1, data)
+    header = _field_bytes(1, blob_type.encode('utf-8')) + _field_varint(3, len(blob))
+    return struct.pack('>I', len(header)) + header + blob
+
+
+def iter_pbf(eles, block_size=8000, compress=True, historical=False):
+    """serialize elements to osm pbf, one blob at a time
+
+Args:
+    eles (iterable): Node, Way or Relation objects, sorted by type
+    block_size (int): maximum number of elements in each block
+    compress (bool): zlib compress each block
+    historical (bool): include the visible flag of each element. Otherwise
+elements which aren't visible are skipped.
+Yields:
+    bytes pbf data
+"""
+    features = ['OsmSchema-V0.6', 'DenseNodes'] + (['HistoricalInformation'] if historical else [])
+    header = b"".join(_field_bytes(4, f.encode('utf-8')) for f in features) + _field_bytes(16, b'simpleosmapi')
+    yield _encode_blob('OSMHeader', header, compress)
+
+    block = []
+    for ele in eles:
+        if not historical and not ele.visible:
+            continue
+        if block and (len(block) >= block_size or ele.type != block[0].type):
+            yield _encode_blob('OSMData', _encode_block(block, historical), compress)
+            block = []
+        block.append(ele)
+    if block:
+        yield _encode_blob('OSMData', _encode_block(block, historical), compress)
+
+def make_pbf(eles, **kwargs):
+    return b"".join(iter_pbf(eles, **kwargs))
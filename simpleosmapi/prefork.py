@@ -0,0 +1,128 @@
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from urllib.parse import quote
+import os, sys, signal, socket, time, traceback, http.client
+
+_read_methods = ('GET', 'HEAD', 'OPTIONS')
+_hop_by_hop = set(['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade'])
+
+
+class ForwardWrites:
+    """wsgi middleware passing requests which may change the database
+(anything other than GET, HEAD and OPTIONS) on to the writer process at
+writer_address, and all others to app"""
+
+    def __init__(self, app, writer_address, timeout=600):
+        self.app = app
+        self.writer_address = writer_address
+        self.timeout = timeout
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] in _read_methods:
+            return self.app(environ, start_response)
+
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length) if length else b''
+
+        path = quote((environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')).encode('latin-1'))
+        if environ.get('QUERY_STRING'):
+            path += '?' + environ['QUERY_STRING']
+
+        headers = dict((k[5:].replace('_', '-').title(), v) for k,v in environ.items() if k.startswith('HTTP_'))
+        if environ.get('CONTENT_TYPE'):
+            headers['Content-Type'] = environ['CONTENT_TYPE']
+
+        conn = http.client.HTTPConnection(*self.writer_address, timeout=self.timeout)
+        try:
+            conn.request(environ['REQUEST_METHOD'], path, body, headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        finally:
+            conn.close()
+
+        start_response('%d %s' % (resp.status, resp.reason),
+            [(k,v) for k,v in resp.getheaders() if not k.lower() in _hop_by_hop])
+        return [data]
+
+
+def _serve(sock, app):
+    #wsgiref server accepting connections on an existing listening socket,
+    #shared with the other worker processes
+    server = WSGIServer(sock.getsockname()[:2], WSGIRequestHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.server_address = sock.getsockname()[:2]
+    server.server_name, server.server_port = server.server_address
+    server.setup_environ()
+    server.set_app(app)
+    server.serve_forever()
+
+def _fork(func):
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        #the parent stops the workers on ctrl-c
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        func()
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def serve_prefork(make_writer_app, make_reader_app, host='localhost', port=9005, workers=4):
+    """serve requests from several processes
+
+workers reader processes accept connections on (host, port), serving read
+requests themselves and forwarding all others to a single writer process,
+which listens on a private port. Each process calls make_writer_app or
+make_reader_app after it is started, to open its own database connections
+(sqlite connections can't be shared over fork), and serves the returned
+wsgi app with wsgiref. Workers which exit are restarted.
+
+Args:
+    make_writer_app (callable): returns the wsgi app for the writer process
+    make_reader_app (callable): returns the wsgi app for reader processes,
+which should open the database read only
+    host (str): address to listen on
+    port (int): port to listen on
+    workers (int): number of reader processes
+"""
+    public = socket.create_server((host, port), backlog=128)
+    private = socket.create_server(('127.0.0.1', 0))
+    writer_address = private.getsockname()[:2]
+
+    def run_writer():
+        public.close()
+        _serve(private, make_writer_app())
+
+    def run_reader():
+        private.close()
+        _serve(public, ForwardWrites(make_reader_app(), writer_address))
+
+    children = {}
+    children[_fork(run_writer)] = run_writer
+    for i in range(workers):
+        children[_fork(run_reader)] = run_reader
+    print("serving on %s:%d with %d reader processes, writer on port %d" % (host, port, workers, writer_address[1]))
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            pid, status = os.wait()
+            func = children.pop(pid, None)
+            if func is not None:
+                print("process %d exited with status %d, restarting" % (pid, status))
+                time.sleep(1)
+                children[_fork(func)] = func
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            os.waitpid(pid, 0)
@@ -0,0 +1,136 @@
+from .database import get_meta, set_meta, _make_ele_curs
+from .xml import make_osm_change_xml
+import os, gzip, time, threading, traceback
+
+_types = ('node', 'way', 'relation')
+_type_order = {'node': 0, 'way': 1, 'relation': 2}
+
+
+def sequence_path(sequence):
+    """path of files for sequence number, e.g. 1234 -> '000/001/234'"""
+    s = "%09d" % sequence
+    return "/".join((s[:3], s[3:6], s[6:]))
+
+def state_text(sequence, timestamp):
+    """contents of a state.txt file, in the format written by osmosis"""
+    return "#%s\nsequenceNumber=%d\ntimestamp=%s\n" % (
+        time.strftime("%a %b %d %H:%M:%S UTC %Y", time.gmtime()), sequence, timestamp.replace(":", "\\:"))
+
+def _change_type(ele):
+    if not ele.visible:
+        return 'delete'
+    return 'create' if ele.version==1 else 'modify'
+
+def _order_changes(eles):
+    #all versions of an element are kept together, in the order added.
+    #Elements whose last version is a delete come after the others,
+    #relations first, as in an upload ordered by plan_changes
+    last = {}
+    for i, ele in enumerate(eles):
+        last[ele.type, ele.id] = i
+    def key(i):
+        ele = eles[i]
+        final = eles[last[ele.type, ele.id]]
+        if final.visible:
+            return (0, _type_order[ele.type], last[ele.type, ele.id], i)
+        return (1, -_type_order[ele.type], last[ele.type, ele.id], i)
+    return [(_change_type(eles[i]), eles[i]) for i in sorted(range(len(eles)), key=key)]
+
+
+class Replication:
+    """write the changes made to an OsmData database as numbered, gzipped
+osmChange files, in the layout used for openstreetmap's minutely diffs:
+
+    directory/state.txt
+    directory/000/000/001.osc.gz
+    directory/000/000/001.state.txt
+
+Each call to update writes one file containing every element version
+added since the previous call. The progress (the last rowid read from each
+element table, and the sequence number) is kept in the database's meta
+table, and updated in the same transaction as the rows are read, so
+nothing is missed or repeated.
+
+Example:
+    >>> repl = Replication('replication')
+    >>> data.close_changeset(cid)
+    >>> repl.update(data)
+"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def update(self, data):
+        """write a diff of the elements added since the last update
+
+The first update on a database doesn't write a diff, just records the
+current position (with sequence number 0), so that existing data isn't
+included.
+
+Args:
+    data (OsmData): writable OsmData object
+Returns:
+    sequence number of the file written, or None if there were no changes
+"""
+        with data.transaction():
+            sequence = int(get_meta(data.conn, 'replication_sequence', -1))
+            if sequence < 0:
+                for ty in _types:
+                    (rowid,), = data.conn.execute("select max(rowid) from "+ty)
+                    set_meta(data.conn, 'replication_'+ty, rowid or 0)
+                self._write_state(0, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+                set_meta(data.conn, 'replication_sequence', 0)
+                return None
+
+            eles = []
+            last = {}
+            for ty in _types:
+                last[ty] = int(get_meta(data.conn, 'replication_'+ty, 0))
+                rows = data.conn.execute("select rowid, * from "+ty+" where rowid>? order by rowid", (last[ty],))
+                for row in rows:
+                    last[ty] = row[0]
+                    eles.append(_make_ele_curs(ty, row[1:]))
+            if not eles:
+                return None
+
+            sequence += 1
+            timestamp = max(e.timestamp or "" for e in eles) or time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+            self._write_diff(sequence, make_osm_change_xml(_order_changes(eles)), timestamp)
+            for ty in _types:
+                set_meta(data.conn, 'replication_'+ty, last[ty])
+            set_meta(data.conn, 'replication_sequence', sequence)
+        print("wrote replication diff %d: %d elements" % (sequence, len(eles)))
+        return sequence
+
+    def start(self, data, interval=60):
+        """call update every interval seconds from a background thread"""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.update(data)
+                except Exception:
+                    traceback.print_exc()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def _replace(self, path, data):
+        #write to a temporary file first, so readers never see partial files
+        path = os.path.join(self.directory, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path+".tmp", 'wb') as obj:
+            obj.write(data)
+        os.replace(path+".tmp", path)
+
+    def _write_state(self, sequence, timestamp):
+        self._replace("state.txt", state_text(sequence, timestamp).encode('utf-8'))
+
+    def _write_diff(self, sequence, xml, timestamp):
+        path = sequence_path(sequence)
+        self._replace(path+".osc.gz", gzip.compress(xml))
+        self._replace(path+".state.txt", state_text(sequence, timestamp).encode('utf-8'))
+        self._write_state(sequence, timestamp)
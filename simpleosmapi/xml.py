@@ -1,5 +1,5 @@
 from .elements import Node, Way, Relation
-import urllib.request
+import urllib.request, itertools, io, gzip, functools
 
 try:
     import lxml.etree as ET
@@ -67,6 +67,8 @@ def _read_obj(ele, active=True):
     timestamp = ele.attrib['timestamp'] if 'timestamp' in ele.attrib else None
     user = ele.attrib['user'] if 'user' in ele.attrib else None
     uid = int(ele.attrib['uid']) if 'uid' in ele.attrib else None
+    if ele.attrib.get('visible')=='false':
+        active = False
     
             
     if ele.tag == 'node':
@@ -85,85 +87,188 @@ def _read_obj(ele, active=True):
         members = [{'type': mem.attrib['type'], 'ref': int(mem.attrib['ref']), 'role': mem.attrib['role']} for mem in ele if mem.tag=='member']
         return Relation(id, changeset, version, timestamp, user, uid, tags, active, members)
 
-def read_osm_xml(download_text):
-    """read osm elements from osm xml string
+class _PrefixedReader:
+    """file-like object returning prefix, then the remainder of obj"""
+    def __init__(self, prefix, obj):
+        self.prefix = prefix
+        self.obj = obj
+    
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.obj.read(size)
+        if size is None or size<0:
+            data, self.prefix = self.prefix + self.obj.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.obj.read(size-len(data))
+        return data
+
+def _open_source(source):
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    
+    head = source.read(2)
+    if isinstance(head, str):
+        raise Exception("expected a binary file object")
+    source = _PrefixedReader(head, source)
+    if head == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=source, mode='rb')
+    return source
+
+def _iterparse(source):
+    #yields the open parent elements and each element as it is completed
+    path = []
+    for event, elem in ET.iterparse(_open_source(source), events=('start','end')):
+        if event=='start':
+            path.append(elem)
+        else:
+            path.pop()
+            yield path, elem
+
+def read_osm_xml(source):
+    """read osm elements from osm xml. The data is parsed incrementally,
+and each element is discarded once read, so memory use doesn't grow with
+the size of the input.
 
 Args:
-    download_text (str): xml data
+    source (str, bytes or file object): xml data, optionally gzipped
 Yields:
     Node, Way or Relation objects
 """
-    root=ET.fromstring(download_text)
-    for ele in root:
-        yield _read_obj(ele)
+    for path, ele in _iterparse(source):
+        if len(path)==1 and ele.tag in ('node','way','relation'):
+            yield _read_obj(ele)
+            path[0].clear()
     
-def read_osm_change_xml(upload_text):
-    """read osm elements from osm change xml string
+def read_osm_change_xml(source):
+    """read osm elements from osm change xml. Parsed incrementally, as
+read_osm_xml.
 
 Args:
-    download_text (str): xml data
+    source (str, bytes or file object): xml data, optionally gzipped
 Yields:
     tuples of change type ('create', 'modify', 'delete') and
     Node, Way or Relation objects
 """
-    root = ET.fromstring(upload_text)
-    
-    for group in root:
-        for ele in group:
+    for path, ele in _iterparse(source):
+        if len(path)==2 and ele.tag in ('node','way','relation'):
+            group = path[1]
             yield group.tag, _read_obj(ele,group.tag!='delete')
+            group.clear()
 
 def elements_from_api(box, host='http://localhost:9005'):
     url = '%s/api/0.6/map?bbox=%f,%f,%f,%f' % (host,box[0],box[1],box[2],box[3])
     txt =urllib.request.urlopen(url).read()
     return read_osm_xml(txt)
 
-def make_osm_xml(eles):
-    resp = []
-    for ele in eles:
-        props = {'id': ele.id, 'version': ele.version, 'timestamp': ele.timestamp, 'user': ele.user, 'uid': ele.uid, 'changeset': ele.changeset}
-        data = [('tag',{'k':k,'v':v},None,None) for k,v in ele.tags.items()]
-        if ele.type=='node':
-            props['lon'] = ele.lon*0.0000001
-            props['lat'] = ele.lat*0.0000001
-        elif ele.type=='way':
-            data += [('nd', {'ref': n},None,None) for n in ele.refs]
-        elif ele.type=='relation':
-            data += [('member', m,None,None) for m in ele.members]
-        
-        
-        resp.append((ele.type,props,None,data))
+def _escape_attrib(val):
+    val = str(val)
+    if "&" in val: val = val.replace("&", "&amp;")
+    if "<" in val: val = val.replace("<", "&lt;")
+    if ">" in val: val = val.replace(">", "&gt;")
+    if '"' in val: val = val.replace('"', "&quot;")
+    if "\r" in val: val = val.replace("\r", "&#13;")
+    if "\n" in val: val = val.replace("\n", "&#10;")
+    if "\t" in val: val = val.replace("\t", "&#09;")
+    return val
+
+_escape_cached = functools.lru_cache(maxsize=1<<16)(_escape_attrib)
+
+@functools.lru_cache(maxsize=1<<18)
+def _coord_str(val):
+    return str(val*0.0000001)
+
+def _attrs_str(props):
+    return "".join(' %s="%s"' % (k, _escape_attrib(v)) for k,v in props.items())
+
+def _element_str(ele, visible=False):
+    #same output as ElementTree's tostring, without creating an ET.Element
+    #for every tag, nd and member
+    esc = _escape_cached
+    parts = ['<', ele.type, ' id="', str(ele.id), '" version="', str(ele.version),
+        '" timestamp="', esc(ele.timestamp), '" user="', esc(ele.user),
+        '" uid="', str(ele.uid), '" changeset="', str(ele.changeset), '"']
+    if visible:
+        parts.append(' visible="true"' if ele.visible else ' visible="false"')
+    if ele.type=='node' and ele.lon is not None:
+        #deleted nodes may not have a location
+        parts += [' lon="', _coord_str(ele.lon), '" lat="', _coord_str(ele.lat), '"']
     
-    return to_xml('osm',osm_headers,None,resp,0)
+    children = ['<tag k="%s" v="%s" />' % (esc(k), esc(v)) for k,v in ele.tags.items()]
+    if ele.type=='way':
+        children += ['<nd ref="%d" />' % n for n in ele.refs]
+    elif ele.type=='relation':
+        children += ['<member%s />' % "".join(' %s="%s"' % (k, esc(v)) for k,v in m.items()) for m in ele.members]
+    
+    if not children:
+        parts.append(' />')
+    else:
+        parts.append('>')
+        parts += children
+        parts += ['</', ele.type, '>']
+    return "".join(parts)
+
+def _encode(parts):
+    return "".join(parts).encode('ascii','xmlcharrefreplace')
+
+def iter_osm_xml(eles, chunk_size=65536, visible=False):
+    """serialize elements to osm xml incrementally
+    
+The output is the same as make_osm_xml, but is produced in chunks of
+around chunk_size bytes as eles is consumed, rather than building the whole
+document first.
+
+Args:
+    eles (iterable): Node, Way or Relation objects
+    chunk_size (int): approximate size of each chunk
+    visible (bool): include the visible attribute of each element, as
+returned by the element and history calls
+Yields:
+    bytes xml data
+"""
+    eles = iter(eles)
+    first = next(eles, None)
+    if first is None:
+        yield _encode(['<osm', _attrs_str(osm_headers), ' />'])
+        return
+    
+    chunk = ['<osm', _attrs_str(osm_headers), '>']
+    size = 0
+    for ele in itertools.chain([first], eles):
+        part = _element_str(ele, visible)
+        chunk.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield _encode(chunk)
+            chunk, size = [], 0
+    chunk.append("</osm>")
+    yield _encode(chunk)
+
+def make_osm_xml(eles, visible=False):
+    return b"".join(iter_osm_xml(eles, visible=visible))
 
 
 def make_osm_change_xml(ele_changes):
-    resp = []
+    resp = ['<osmChange', _attrs_str(osm_headers)]
     
     lastct = None
-    part = []
     for changetype, ele in ele_changes:
         if changetype != lastct:
-            if part:
-                resp.append((lastct,{},None,part))
+            resp.append('>' if lastct is None else '</%s>' % lastct)
+            resp.append('<%s>' % changetype)
             lastct = changetype
-            part = []
-        
         
-        props = {'id': ele.id, 'version': ele.version, 'timestamp': ele.timestamp, 'user': ele.user, 'uid': ele.uid, 'changeset': ele.changeset}
-        data = [('tag',{'k':k,'v':v},None,None) for k,v in ele.tags.items()]
-        if ele.type=='node':
-            props['lon'] = ele.lon*0.0000001
-            props['lat'] = ele.lat*0.0000001
-        elif ele.type=='way':
-            data += [('nd', {'ref': n},None,None) for n in ele.refs]
-        elif ele.type=='relation':
-            data += [('member', m,None,None) for m in ele.members]
-        part.append((ele.type,props,None,data))
+        resp.append(_element_str(ele))
         
-    if part:
-        resp.append((lastct,{},None,part))
+    if lastct is None:
+        resp.append(' />')
+    else:
+        resp.append('</%s></osmChange>' % lastct)
     
-    return to_xml('osmChange',osm_headers,None,resp,0)
+    return _encode(resp)
 
 osm_headers = {'version':"0.6", 'generator': "simpleosmserver server",
     'copyright': "OpenStreetMap and contributors",
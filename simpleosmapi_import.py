@@ -0,0 +1,46 @@
+import argparse, os, bz2
+
+from simpleosmapi import make_sqlite, bulk_load, read_osm_xml, read_osm_change_xml, read_pbf
+
+
+parser = argparse.ArgumentParser(description="""
+load .osm and .osc files (optionally gzip or bzip2 compressed) and .pbf
+files into an sqlite database""")
+
+parser.add_argument("filename", metavar='filename', type=str, nargs=1,
+    help="sqlite database")
+parser.add_argument("inputs", metavar='input', type=str, nargs='+',
+    help=".osm, .osc or .pbf files, loaded in the order given")
+parser.add_argument("-c", "--create", action='store_true',
+    help="create the database if it doesn't exist")
+parser.add_argument("-b", "--batch_size", metavar='batchsize', type=int, default=10000)
+parser.add_argument("--codec", metavar='codec', type=str, default='packed',
+    choices=['packed','json'], help="column format for a new database (default packed)")
+parser.add_argument("-j", "--workers", metavar='workers', type=int, default=None,
+    help="processes used to decode .pbf files (default number of cpus)")
+
+
+def read_input(fn, workers=None):
+    if fn.endswith('.pbf'):
+        yield from read_pbf(fn, workers)
+        return
+    
+    #gzip compressed input is detected by the readers
+    opener = bz2.open if fn.endswith('.bz2') else open
+    reader = read_osm_change_xml if '.osc' in os.path.basename(fn) else read_osm_xml
+    with opener(fn, 'rb') as obj:
+        yield from reader(obj)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    filename = args.filename[0]
+    
+    if not os.path.exists(filename) and not args.create:
+        raise Exception("database %s doesn't exist" % filename)
+    
+    conn = make_sqlite(filename, args.create, codec=args.codec)
+    for fn in args.inputs:
+        print("loading %s" % fn)
+        bulk_load(conn, read_input(fn, args.workers), args.batch_size)
+    conn.close()
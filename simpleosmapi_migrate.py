@@ -0,0 +1,38 @@
+import argparse, os
+
+from simpleosmapi import make_sqlite, migrate_codec, rebuild_boxes
+
+
+parser = argparse.ArgumentParser(description="""
+convert the tags, refs and members stored in an existing database to a
+different column format, and recalculate element boxes""")
+
+parser.add_argument("filename", metavar='filename', type=str, nargs=1,
+    help="sqlite database")
+parser.add_argument("-c", "--codec", metavar='codec', type=str, default=None,
+    choices=['packed','json'], help="rewrite the stored data in this column format")
+parser.add_argument("-b", "--boxes", action='store_true',
+    help="recalculate the boxes of all ways and relations, for databases written before they were kept up to date")
+parser.add_argument("-v", "--vacuum", action='store_true',
+    help="vacuum the database afterwards, to reclaim the freed space")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    filename = args.filename[0]
+    
+    conn = make_sqlite(filename)
+    before = os.path.getsize(filename)
+    
+    if args.codec:
+        count = migrate_codec(conn, args.codec)
+        print("rewrote %d rows as %s" % (count, args.codec))
+    
+    if args.boxes:
+        count = rebuild_boxes(conn)
+        print("changed %d boxes" % count)
+    
+    if args.vacuum:
+        conn.execute("vacuum")
+        print("file size %d => %d bytes" % (before, os.path.getsize(filename)))
+    conn.close()
@@ -1,12 +1,16 @@
 import sqlite3, os, sys,time, json
 
-import pkg_resources,mimetypes, argparse
+import pkg_resources,mimetypes, argparse, functools
 import xml.etree.ElementTree as ET
 
 from bottle import route, run, template,static_file,request,post, response, put, hook
 import bottle
 
-from simpleosmapi import to_xml, OsmData, read_osm_change_xml, make_sqlite, make_osm_xml, osm_headers
+from simpleosmapi import to_xml, OsmData, read_osm_change_xml, make_sqlite, iter_osm_xml, osm_headers, ResponseCache
+from simpleosmapi.metrics import Metrics, stage, count, count_iter
+from simpleosmapi.asgi import AsgiApp, asgi_servers, run_asgi
+from simpleosmapi.prefork import serve_prefork
+from simpleosmapi.replication import Replication
 
 
 parser = argparse.ArgumentParser(description="""
@@ -18,22 +22,108 @@ parser.add_argument("-i", "--user_id", metavar='userid', type=int,default=1)
 parser.add_argument("-u", "--user_name", metavar='username', type=str,default="one")
 parser.add_argument("-p", "--port", metavar='port', type=int,default=9005)
 parser.add_argument("-c", "--create", action='store_true')
+parser.add_argument("-s", "--server", metavar='server', type=str, default='wsgiref',
+    help="bottle server adapter, use a threaded server (e.g. cheroot, waitress) to serve requests concurrently, "+
+        "or uvicorn or hypercorn to serve through an asgi app with a writer thread and a pool of reader threads")
+parser.add_argument("-r", "--readers", metavar='readers', type=int, default=4,
+    help="number of read only database connections, and of reader threads with an asgi server")
+parser.add_argument("-w", "--workers", metavar='workers', type=int, default=0,
+    help="serve map requests from this many processes, sending changes to a single writer process (default 0, serve from this process)")
+parser.add_argument("--synchronous", metavar='synchronous', type=str, default='full',
+    choices=['off','normal','full','extra'], help="sqlite synchronous setting (default full)")
+parser.add_argument("--cache", metavar='entries', type=int, default=0,
+    help="number of /api/0.6/map responses to cache in memory (default 0, no cache)")
+parser.add_argument("--cache_dir", metavar='directory', type=str, default=None,
+    help="directory for cached responses evicted from memory")
+parser.add_argument("--server_timing", action='store_true',
+    help="add Server-Timing headers giving the time taken by each stage of a request")
+parser.add_argument("--replication", metavar='directory', type=str, default=None,
+    help="write osmChange diffs of all changes to this directory, served at /replication/")
+parser.add_argument("--replication_interval", metavar='seconds', type=float, default=0,
+    help="write a replication diff every this many seconds (default 0, write one when each changeset is closed)")
 
-args = parser.parse_args()
-print(args)
-filename = args.filename[0]
+stored_data = None
+response_cache = None
+metrics = Metrics()
+server_timing = False
+replication = None
+replication_dir = None
 
+def setup(filename, user_id=1, user_name='one', create=False, readers=4, synchronous='full', cache=0, cache_dir=None, timing_headers=False, readonly=False, replication_directory=None, replication_interval=0):
+    """open the database served by the routes below. Called with the command
+line arguments when run as a script, or directly when the routes are used
+from another module (e.g. through bottle.default_app())"""
+    global stored_data, response_cache, server_timing, replication, replication_dir
+    
+    if not os.path.exists(filename):
+        if create:
+            make_sqlite(filename,True)
+        else:
+            raise Exception("database %s doesn't exist" % filename)
+    
+    stored_data = OsmData(filename, user_id, user_name, readers, synchronous=synchronous, readonly=readonly)
+    
+    response_cache = None
+    if cache:
+        response_cache = ResponseCache(cache, directory=cache_dir)
+        stored_data.listeners.append(response_cache.invalidate)
+    server_timing = timing_headers
+    
+    #only the process writing to the database writes diffs, but all serve them
+    replication, replication_dir = None, replication_directory
+    if replication_directory and not readonly:
+        repl = Replication(replication_directory)
+        repl.update(stored_data)
+        if replication_interval:
+            repl.start(stored_data, replication_interval)
+        else:
+            #changeset_close writes a diff
+            replication = repl
+    return stored_data
 
 
-if not os.path.exists(filename):
-    if args.create:
-        make_sqlite(filename,True)
-    else:
-        raise Exception("database %s doesn't exist" % filename)
-    
+def timed(name):
+    """record the time taken by each stage of a route, and the size of its
+response, in metrics. Streamed responses are timed until the last chunk
+is sent, so Server-Timing headers only cover the stages up to the first
+chunk."""
+    def wrap(func):
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            req = metrics.start(name)
+            try:
+                with req.activate():
+                    result = func(*args, **kwargs)
+                    streamed = not (result is None or isinstance(result, (bytes, str)))
+                    if streamed:
+                        chunks = iter(result)
+                        with stage('serialize'):
+                            first = next(chunks, None)
+            except:
+                metrics.finish(req)
+                raise
+            
+            if server_timing:
+                response.set_header('Server-Timing', req.server_timing())
+            if streamed:
+                return _timed_stream(req, first, chunks)
+            req.response_bytes = len(result) if result else 0
+            metrics.finish(req)
+            return result
+        return call
+    return wrap
 
-    
-stored_data = OsmData(filename, args.user_id, args.user_name)
+def _timed_stream(req, chunk, chunks):
+    try:
+        while chunk is not None:
+            req.response_bytes += len(chunk)
+            yield chunk
+            with req.activate(), stage('serialize'):
+                chunk = next(chunks, None)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        metrics.finish(req)
 
 @hook('after_request')
 def enable_cors():
@@ -83,7 +173,7 @@ capabilities_content = [
 @route('/api/0.6/changesets')
 def changesets():
     response.content_type = 'text/xml'
-    return to_xml('osm',osm_headers,None,[changeset_xml(c) for c in stored_data.changesets.itervalues()])
+    return to_xml('osm',osm_headers,None,[changeset_xml(c) for c in stored_data.load_changesets()])
     
 
 @route('/api/0.6/changeset/create',method=['OPTIONS','PUT'])
@@ -128,20 +218,22 @@ def changeset_reopen(cid):
     
 
 @post('/api/0.6/changeset/<cid:int>/upload')
+@timed('upload')
 def changeset_upload(cid):
     response.headers['Access-Control-Allow-Origin'] = '*'
-    if not cid in stored_data.changesets:
+    chg = stored_data.get_changeset(cid)
+    if chg is None:
         response.response_code = 404
         return
     
-    if not stored_data.changesets[cid].active:
+    if not chg.active:
         response.response_code = 409
         return "changeset %d closed" % cid
     
     
-    req_data = request.body.read()
-    
-    elements = list(read_osm_change_xml(req_data))
+    with stage('parse'):
+        elements = list(read_osm_change_xml(request.body))
+    count('elements', len(elements))
     response_data = stored_data.add_changeset_data(cid, elements)
     
     response.content_type = 'text/xml'
@@ -152,9 +244,12 @@ def changeset_close(cid):
     print('changeset_close', cid)
     stored_data.close_changeset(cid)
     stored_data.save()
+    if replication is not None:
+        replication.update(stored_data)
     return
     
 @route('/api/0.6/map')
+@timed('map')
 def map_data():
     rd = request.query.decode()
     #print(req_data)
@@ -168,11 +263,99 @@ def map_data():
     if 'bbox' in rd:
         box=[float(q) for q in rd['bbox'].split(",")]
     
-    eles = stored_data.iter_elements(box)
+    if response_cache is not None:
+        cached = response_cache.get(box)
+        if cached is not None:
+            return cached
     
-    return make_osm_xml(eles)
+    eles = count_iter(stored_data.iter_elements(box), 'elements')
     
+    #returning a generator lets bottle stream the response as it is written
+    if response_cache is not None:
+        return response_cache.iter_response(box, eles, iter_osm_xml)
+    return iter_osm_xml(eles)
     
+    
+
+def _element_response(eles):
+    response.content_type = 'text/xml'
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    count('elements', len(eles))
+    return iter_osm_xml(eles, visible=True)
+
+@route('/api/0.6/<ty:re:node|way|relation>/<id_:int>')
+@timed('element')
+def element(ty, id_):
+    eles = stored_data.get_elements(ty, [id_])
+    if not eles:
+        bottle.abort(404, "%s %d not found" % (ty, id_))
+    if not eles[0].visible:
+        bottle.abort(410, "%s %d has been deleted" % (ty, id_))
+    return _element_response(eles)
+
+@route('/api/0.6/<ty:re:way|relation>/<id_:int>/full')
+@timed('full')
+def element_full(ty, id_):
+    eles = stored_data.get_full(ty, id_)
+    if not eles:
+        if stored_data.get_elements(ty, [id_]):
+            bottle.abort(410, "%s %d has been deleted" % (ty, id_))
+        bottle.abort(404, "%s %d not found" % (ty, id_))
+    return _element_response(eles)
+
+@route('/api/0.6/<ty:re:node|way|relation>/<id_:int>/history')
+@timed('history')
+def element_history(ty, id_):
+    eles = stored_data.get_history(ty, id_)
+    if not eles:
+        bottle.abort(404, "%s %d not found" % (ty, id_))
+    return _element_response(eles)
+
+@route('/api/0.6/<ty:re:node|way|relation>/<id_:int>/<version:int>')
+@timed('version')
+def element_version(ty, id_, version):
+    eles = stored_data.get_versions(ty, [(id_, version)])
+    if not eles:
+        bottle.abort(404, "%s %d version %d not found" % (ty, id_, version))
+    return _element_response(eles)
+
+@route('/api/0.6/<tys:re:nodes|ways|relations>')
+@timed('elements')
+def elements_multi(tys):
+    ty = tys[:-1]
+    ids, versions = [], []
+    try:
+        for s in request.query.get(tys, '').split(','):
+            if 'v' in s:
+                i, v = s.split('v')
+                versions.append((int(i), int(v)))
+            elif s:
+                ids.append(int(s))
+    except ValueError:
+        bottle.abort(400, "can't parse %s parameter" % tys)
+    if not ids and not versions:
+        bottle.abort(400, "the %s parameter must be given" % tys)
+    
+    #all the ids are fetched with one query, all the versions with another
+    eles = stored_data.get_elements(ty, ids) if ids else []
+    if versions:
+        eles = sorted(eles + stored_data.get_versions(ty, versions), key=lambda e: (e.id, e.version))
+    if len(eles) < len(set(ids)) + len(set(versions)):
+        bottle.abort(404, "not all %s found" % tys)
+    return _element_response(eles)
+
+@route('/replication/<path:path>')
+def replication_file(path):
+    if replication_dir is None:
+        return bottle.HTTPError(404, "replication not enabled")
+    #served as is: a Content-Encoding header would have clients unzip the diffs
+    mimetype = 'application/gzip' if path.endswith('.gz') else 'text/plain'
+    return static_file(path, root=replication_dir, mimetype=mimetype)
+
+@route('/metrics')
+def metrics_data():
+    response.content_type = 'text/plain; version=0.0.4'
+    return metrics.exposition()
 
 @route('/api/0.6/user/details')
 def user_details():
@@ -197,4 +380,34 @@ def file(fname):
     return static_file(fname, root='./')
 
 if __name__ == "__main__":
-    run(host='localhost', port=args.port)
+    args = parser.parse_args()
+    print(args)
+    filename = args.filename[0]
+    
+    if args.workers:
+        #each worker would keep its own cache, which uploads to the writer
+        #process wouldn't invalidate
+        if args.cache:
+            raise Exception("--cache can't be used with --workers")
+        
+        #create or upgrade the database before starting the workers
+        if not os.path.exists(filename) and not args.create:
+            raise Exception("database %s doesn't exist" % filename)
+        make_sqlite(filename, not os.path.exists(filename)).close()
+        
+        def worker_app(readonly):
+            setup(filename, args.user_id, args.user_name, False, args.readers,
+                args.synchronous, 0, None, args.server_timing, readonly,
+                args.replication, args.replication_interval)
+            return bottle.default_app()
+        
+        serve_prefork(lambda: worker_app(False), lambda: worker_app(True), 'localhost', args.port, args.workers)
+        sys.exit(0)
+    
+    setup(filename, args.user_id, args.user_name, args.create, args.readers,
+        args.synchronous, args.cache, args.cache_dir, args.server_timing, False,
+        args.replication, args.replication_interval)
+    if args.server in asgi_servers:
+        run_asgi(AsgiApp(bottle.default_app(), args.readers), 'localhost', args.port, args.server)
+    else:
+        run(host='localhost', port=args.port, server=args.server)
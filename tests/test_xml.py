@@ -0,0 +1,77 @@
+"""check the osm xml writers against golden files
+
+The files in tests/golden were written by the ElementTree based writer
+which make_osm_xml and make_osm_change_xml replaced, so any change to the
+output of the writers shows up here.
+"""
+
+import sys, os, gzip, random
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+from simpleosmapi import Node, Way, Relation, make_osm_xml, iter_osm_xml, make_osm_change_xml
+
+golden_dir = os.path.join(here, 'golden')
+
+special_tags = {'a&b': '<x> "q" \'s\'\n\t\r', 'name': 'Zürich 東京 😀', '': '', 'k<>': '&amp; ]]>'}
+
+
+def read_golden(name):
+    opener = gzip.open if name.endswith('.gz') else open
+    with opener(os.path.join(golden_dir, name), 'rb') as obj:
+        return obj.read()
+
+
+def special_elements():
+    """elements needing escaping, non-ascii text, and elements without
+tags, refs or members"""
+    ts = '2020-01-01T00:00:00Z'
+    return [
+        Node(1, 5, 1, ts, 'u', 7, {}, True, 0, 0),
+        Node(2, 5, 2, ts, 'ü&"<>', 7, special_tags, True, -1234567, 899999999),
+        Node(3, 5, 1, ts, 'u', 7, {'a': 'b'}, True, 1, -5),
+        Node(4, 5, 1, ts, 'u', 7, {}, True, 1800000000, -900000000),
+        Node(5, 5, 1, ts, 'u', 7, {}, True, -1799999999, 123),
+        Way(2, 5, 1, ts, 'u&"<', 7, special_tags, True, [1, -2, 3]),
+        Way(3, 5, 1, ts, 'u', 7, {}, True, []),
+        Way(4, 5, 3, ts, 'u', 7, {'highway': 'residential'}, True, [1, 2, 3, 4, 1]),
+        Relation(4, 5, 1, ts, 'u', 7, {}, True, [{'type': 'node', 'ref': 1, 'role': 'a&"'}, {'role': 'x', 'type': 'way', 'ref': 2}]),
+        Relation(5, 5, 1, ts, 'u', 7, {}, True, []),
+        Relation(6, 5, 2, ts, 'u', 7, special_tags, True, [{'type': 'relation', 'ref': 4, 'role': 'ü\n'}]),
+    ]
+
+def special_changes():
+    eles = special_elements()
+    return [('create', e) for e in eles[:5]] + [('modify', e) for e in eles[5:8]] + [('delete', e) for e in eles[8:10]] + [('create', eles[10])]
+
+def random_nodes(num=500, seed=1):
+    """nodes with random locations and metadata"""
+    rand = random.Random(seed)
+    nodes = []
+    for i in range(num):
+        tags = {} if rand.random() < 0.8 else {'amenity': rand.choice(['bench', 'cafe', 'pub'])}
+        nodes.append(Node(i+1, rand.randint(1, 10**8), rand.randint(1, 50), '2020-01-01T00:00:00Z',
+            'user%d' % rand.randint(1, 100), rand.randint(1, 100), tags, True,
+            rand.randint(-1800000000, 1800000000), rand.randint(-900000000, 900000000)))
+    return nodes
+
+
+def test_special_elements():
+    assert make_osm_xml(special_elements()) == read_golden('special.osm')
+
+def test_empty():
+    assert make_osm_xml([]) == read_golden('empty.osm')
+    assert make_osm_change_xml([]) == read_golden('empty.osc')
+
+def test_random_coordinates():
+    assert make_osm_xml(random_nodes()) == read_golden('random_nodes.osm.gz')
+
+def test_iter_osm_xml_chunks():
+    chunks = list(iter_osm_xml(random_nodes(), chunk_size=4096))
+    assert len(chunks) > 1
+    assert b"".join(chunks) == read_golden('random_nodes.osm.gz')
+    assert b"".join(iter_osm_xml(special_elements(), chunk_size=100)) == read_golden('special.osm')
+
+def test_change():
+    assert make_osm_change_xml(special_changes()) == read_golden('special.osc')